@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import argparse
+import logging
+import time
+import numpy as np
+
+from listwise_ranker import FeatureSource, RankingData, add_ranker_arguments, fold_queries, has_training_queries, ranker_context, train_coordinate_ascent
+from feature_join import ORIG_SCORE
+from feature_schema import ALL_PROMPT_CLASSES, CRITERIA
+from run_io import Run
+from trec_metrics import Qrels, read_qrels, rank_run, metric_matrix
+
+GROUPINGS = ('prompt_class', 'criterion')
+
+# Variant with every feature; '-<group>' leaves a group out, '+<group>' keeps only that group
+ALL_FEATURES = 'all'
+# Per-query scores of the base run itself
+ORIGINAL = 'original'
+METRICS = ["ndcg_cut_20", "map"]
+
+class FoldScores(NamedTuple):
+    """Per-query scores {variant: {qid: [value per metric]}} of the test queries of one fold of one system."""
+    system: str
+    fold: int
+    scores: Dict[str, Dict[str, List[float]]]
+
+def feature_group(name: str, group_by: str) -> str:
+    """Group of a feature: its prompt class (longest matching prefix) or criterion, else the feature itself."""
+    if name == ORIG_SCORE:
+        return ORIG_SCORE
+    if group_by == 'prompt_class':
+        # feature_schema names features '<prompt class>_...'
+        matches = [pclass for pclass in ALL_PROMPT_CLASSES if name.startswith(pclass + '_')]
+        return max(matches, key=len) if matches else name
+    stem = name[:-len('.run')] if name.endswith('.run') else name
+    return stem if stem in CRITERIA else name
+
+def feature_groups(feature_names: List[str], group_by: str) -> Dict[str, np.ndarray]:
+    """Column indices of every feature group, in order of first appearance."""
+    groups: Dict[str, List[int]] = {}
+    for i, name in enumerate(feature_names):
+        groups.setdefault(feature_group(name, group_by), []).append(i)
+    return {group: np.array(columns) for group, columns in groups.items()}
+
+def ablation_variants(feature_names: List[str], group_by: str) -> Dict[str, np.ndarray]:
+    """Columns of every variant: all features, and each group left out ('-g') or alone ('+g')."""
+    groups = feature_groups(feature_names, group_by)
+    everything = np.arange(len(feature_names))
+    variants = {ALL_FEATURES: everything}
+    if len(groups) > 1:
+        for group, columns in groups.items():
+            variants[f"-{group}"] = np.setdiff1d(everything, columns)
+        for group, columns in groups.items():
+            variants[f"+{group}"] = columns
+    return variants
+
+def evaluate_rows(data: RankingData, rows: np.ndarray, scores: np.ndarray, qrels: Qrels, metrics: List[str]) -> Dict[str, List[float]]:
+    """Per-query metrics of the given rows of a system ranked by `scores`, as ndcg_eval_script scores the run file."""
+    run = Run(data.run.vocab, data.run.qids[rows], data.run.docids[rows], np.round(scores, 6), np.zeros(len(rows), dtype=np.int64))
+    ranked = rank_run(run, qrels)
+    values = metric_matrix(ranked, qrels, metrics)
+    return dict(zip(qrels.vocab.qids.decode(ranked.query_codes), values.tolist()))
+
+# Shared by the fold tasks of a worker process
+_source: Optional[FeatureSource] = None
+_eval_qrels: Optional[Qrels] = None
+
+def _init_worker(context: dict):
+    global _source, _eval_qrels
+    _source = FeatureSource(context)
+    _eval_qrels = read_qrels(context['eval_qrel'], _source.qrels.vocab) if context['eval_qrel'] else _source.qrels
+
+def _fold_task(task: Tuple[str, int]) -> Optional[FoldScores]:
+    """
+    Train every variant on all folds but `fold` of a system and score the test queries of `fold`.
+    None if the system has no queries to train on; no scores if `fold` has no test queries.
+    """
+    system, fold = task
+    context = _source.context
+    folds = _source.system_folds(system)
+    if not has_training_queries(folds):
+        return None
+    if not np.any(folds.fold_of == fold):
+        return FoldScores(system, fold, {})
+    data = folds.data
+    # Standardization is per column, so it is done once for all variants
+    train, test = fold_queries(folds, fold, context['zscore'])
+
+    test_rows = test.rows[test.rows >= 0]
+    scores = {ORIGINAL: evaluate_rows(data, test_rows, data.run.scores[test_rows], _eval_qrels, context['metrics'])}
+    for variant, columns in ablation_variants(data.feature_names, context['group_by']).items():
+        rng = np.random.default_rng([context['seed'], fold])
+        weights, _ = train_coordinate_ascent(train._replace(features=train.features[:, :, columns]),
+                                             context['restarts'], context['threshold'], rng)
+        doc_scores = test.features[:, :, columns] @ weights
+        scores[variant] = evaluate_rows(data, test_rows, doc_scores[test.rows >= 0], _eval_qrels, context['metrics'])
+    return FoldScores(system, fold, scores)
+
+def run_ablation(systems: List[str], context: dict, workers: int) -> Dict[str, Dict[str, Dict[str, List[float]]]]:
+    """
+    Per-query scores {system: {variant: {qid: [value per metric]}}} over the test folds of every
+    system, `workers` (system, fold) tasks at a time. All folds of a system go to the same
+    worker, which joins the system and assigns its folds once. Systems with fewer than two
+    judged queries have nothing to train on and are left out with a warning.
+    """
+    tasks = [(system, fold) for system in systems for fold in range(context['folds'])]
+    results: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+    skipped = set()
+
+    def collect(system: str, result: Optional[FoldScores]):
+        if result is None:
+            skipped.add(system)
+            return
+        for variant, scores in result.scores.items():
+            results.setdefault(system, {}).setdefault(variant, {}).update(scores)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(context,)) as pool:
+            for task, result in zip(tasks, pool.map(_fold_task, tasks, chunksize=context['folds'])):
+                collect(task[0], result)
+    else:
+        _init_worker(context)
+        for task in tasks:
+            collect(task[0], _fold_task(task))
+    for system in sorted(skipped):
+        logging.warning(f"Skipping {system}: fewer than two of its queries are judged, no fold has queries to train on")
+        results.pop(system, None)
+    return results
+
+def mean_scores(per_query: Dict[str, List[float]], n_metrics: int) -> np.ndarray:
+    return np.mean(list(per_query.values()), axis=0) if per_query else np.zeros(n_metrics)
+
+def quartiles(original: Dict[str, float]) -> Dict[str, int]:
+    """Quartile (1 = weakest) of every system by its original score."""
+    ranked = sorted(original, key=lambda system: original[system])
+    return {system: 1 + 4 * i // len(ranked) for i, system in enumerate(ranked)}
+
+def write_reports(results: Dict[str, Dict[str, Dict[str, List[float]]]], metrics: List[str], output_dir: Path):
+    """
+    Write ablation_systems.tsv (mean of every metric per system and variant) and
+    ablation_quartiles.tsv (per quartile of the systems by their original first metric:
+    mean original and reranked score, their difference, the difference to the variant
+    with all features and the number of systems the variant improves).
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    means = {system: {variant: mean_scores(scores, len(metrics)) for variant, scores in variants.items()}
+             for system, variants in results.items()}
+    quartile_of = quartiles({system: variants[ORIGINAL][0] for system, variants in means.items()})
+    variants = list(next(iter(means.values()))) if means else []
+
+    with (output_dir / 'ablation_systems.tsv').open('w') as f:
+        f.write("\t".join(["system", "quartile", "variant"] + metrics) + "\n")
+        for system in sorted(means, key=lambda s: (quartile_of[s], s)):
+            for variant, values in means[system].items():
+                f.write("\t".join([system, f"Q{quartile_of[system]}", variant] + [f"{v:.4f}" for v in values]) + "\n")
+
+    metric = metrics[0]
+    with (output_dir / 'ablation_quartiles.tsv').open('w') as f:
+        f.write(f"# {metric} per quartile of the systems by their original {metric} (Q1 = weakest)\n")
+        f.write("quartile\tvariant\tsystems\toriginal\treranked\tdiff\tvs_all\timproved\n")
+        for quartile in sorted(set(quartile_of.values())):
+            members = [system for system in means if quartile_of[system] == quartile]
+            original = np.array([means[system][ORIGINAL][0] for system in members])
+            everything = np.array([means[system][ALL_FEATURES][0] for system in members])
+            for variant in variants:
+                if variant == ORIGINAL:
+                    continue
+                reranked = np.array([means[system][variant][0] for system in members])
+                f.write(f"Q{quartile}\t{variant}\t{len(members)}\t{original.mean():.4f}\t{reranked.mean():.4f}\t"
+                        f"{(reranked - original).mean():+.4f}\t{(reranked - everything).mean():+.4f}\t"
+                        f"{int((reranked > original).sum())}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Feature group ablation of the listwise reranker: every leave-one-group-out and single-group variant, cross-validated per system and reported per system quartile")
+    add_ranker_arguments(parser)
+    parser.add_argument("--eval-qrel", type=Path, help="Qrels used for evaluation (default: --qrel)")
+    parser.add_argument("--group-by", choices=GROUPINGS, default='criterion', help="Feature groups: criterion run files or prompt classes of the feature names (default: criterion)")
+    parser.add_argument("--metrics", nargs='+', default=METRICS, help=f"Evaluation metrics, trec_eval names; quartiles use the first (default: {' '.join(METRICS)})")
+    parser.add_argument("--output", "-o", required=True, type=Path, help="Output directory for the reports")
+    parser.add_argument("--workers", type=int, default=1, help="Number of (system, fold) tasks run in parallel")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    systems, context = ranker_context(parser, args)
+    context.update(eval_qrel=args.eval_qrel, group_by=args.group_by, metrics=args.metrics)
+    start = time.time()
+    logging.info(f"Ablating feature groups by {args.group_by} for {len(systems)} systems with {args.folds}-fold cross-validation")
+    results = run_ablation(systems, context, args.workers)
+    write_reports(results, args.metrics, args.output)
+    logging.info(f"Wrote {args.output / 'ablation_quartiles.tsv'} and {args.output / 'ablation_systems.tsv'} in {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,61 @@
 import os
 import glob
-import subprocess
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from run_io import RunVocab
+from filter_features_by_system_run import read_run, write_filtered_run
 
 def get_run_name(run_path):
     return os.path.splitext(os.path.basename(run_path))[0]
 
+# Feature runs by file name, set once per worker process
+_feature_runs = None
+
+def _init_worker(feature_runs):
+    global _feature_runs
+    _feature_runs = feature_runs
+
+def filter_base_run(base_run_path, output_root, feature_runs=None):
+    """Write the feature runs restricted to the (qid, docid) pairs of one base run."""
+    feature_runs = _feature_runs if feature_runs is None else feature_runs
+    run_name = get_run_name(base_run_path)
+    output_dir = os.path.join(output_root, run_name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Base run ids are looked up in the vocabulary of the feature runs, so the join is on integer
+    # keys; pairs with ids no feature run has cannot match and are dropped, so the vocabulary
+    # stays the same for every base run
+    vocab = next(iter(feature_runs.values())).vocab if feature_runs else RunVocab()
+    base_run = read_run(base_run_path, vocab, intern=False)
+    for name, feature_run in feature_runs.items():
+        write_filtered_run(feature_run, base_run, os.path.join(output_dir, name), presorted=True)
+    return run_name
+
 def main():
-    base_run_dir = "/home/nf1104/work/data/runs/runs_trecdl2019"
-    feature_dir = "/home/nf1104/work/Summer 25/LTR_Rubric/train/llama3.3-70b/dl19"
-    output_root = os.path.join(feature_dir, "filtered_dl19")
-
-    base_runs = glob.glob(os.path.join(base_run_dir, "*.run"))
-    feature_runs = glob.glob(os.path.join(feature_dir, "*.run"))
-
-    for base_run in base_runs:
-        run_name = get_run_name(base_run)
-        output_dir = os.path.join(output_root, run_name)
-        os.makedirs(output_dir, exist_ok=True)
-
-        print(f"Processing: {run_name}")
-        cmd = [
-            "python", "./src/filter_features_by_system_run.py",
-            "--base-run", base_run,
-            "--feature-runs", *feature_runs,
-            "--output-dir", output_dir,
-        ]
-        subprocess.run(cmd, check=True)
+    parser = argparse.ArgumentParser(description="Filter feature run files to the query-document pairs of every base system run")
+    parser.add_argument("--base-run-dir", required=True, help="Directory with the base system *.run files")
+    parser.add_argument("--feature-dir", required=True, help="Directory with the feature *.run files (from build_feature_vectors.py)")
+    parser.add_argument("--output-root", help="Output directory, one subdirectory per base run (default: <feature-dir>/filtered)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of base runs filtered in parallel")
+    args = parser.parse_args()
+
+    output_root = args.output_root or os.path.join(args.feature_dir, "filtered")
+    base_runs = sorted(glob.glob(os.path.join(args.base_run_dir, "*.run")))
+    feature_runs = sorted(glob.glob(os.path.join(args.feature_dir, "*.run")))
+
+    # Every feature run is read and sorted once, then shared by all base runs
+    vocab = RunVocab()
+    indexed_runs = {os.path.basename(path): read_run(path, vocab).sorted_by_ids() for path in feature_runs}
+    print(f"Loaded {len(indexed_runs)} feature runs, filtering against {len(base_runs)} base runs")
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(indexed_runs,)) as pool:
+            for run_name in pool.map(filter_base_run, base_runs, [output_root] * len(base_runs)):
+                print(f"Processed: {run_name}")
+    else:
+        for base_run in base_runs:
+            print(f"Processed: {filter_base_run(base_run, output_root, indexed_runs)}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple
+import argparse
+import time
+
+import judgments
+from judgments import QueryGrades, iter_query_grades, iter_lean_query_grades
+
+def time_reader(read: Callable[[Path], Iterator[QueryGrades]], path: Path, repeat: int) -> Tuple[float, List[QueryGrades]]:
+    """Best wall-clock time of reading all queries of `path` with `read`, and the queries read."""
+    best = float('inf')
+    queries = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        queries = list(read(path))
+        best = min(best, time.perf_counter() - start)
+    return best, queries
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the exam_pp judgements parser with the lean reader (judgments.iter_lean_query_grades)")
+    parser.add_argument('--judgements', '-j', type=Path, required=True, help='exampp judgements file (JSONL.gz)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per reader; the best time is reported (default: 3)')
+    parser.add_argument('--threads', type=int, default=2, help='Decompression threads of the lean reader, if isal is installed (default: 2)')
+    args = parser.parse_args()
+
+    size = args.judgements.stat().st_size
+    print(f"Judgements: {args.judgements} ({size / 1024 ** 2:.1f} MiB compressed)")
+    print(f"JSON decoder: {'orjson' if judgments.orjson is not None else 'json'}, "
+          f"decompression: {'isal, %d threads' % args.threads if judgments.igzip_threaded is not None else 'gzip, 1 background thread'}")
+
+    full_time, full = time_reader(iter_query_grades, args.judgements, args.repeat)
+    lean_time, lean = time_reader(lambda path: iter_lean_query_grades(path, threads=args.threads), args.judgements, args.repeat)
+    if lean != full:
+        raise SystemExit("The lean reader returned different self-ratings than the exam_pp parser")
+
+    n_paragraphs = sum(len(q.paragraphs) for q in full)
+    for name, seconds in [('exam_pp', full_time), ('lean', lean_time)]:
+        print(f"{name:>8}: {seconds:8.3f} s  {len(full) / seconds:10.1f} queries/s  {n_paragraphs / seconds:12.1f} paragraphs/s")
+    print(f"Speedup: {full_time / lean_time:.2f}x ({len(full)} queries, {n_paragraphs} paragraphs, identical output)")
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,204 @@
 #!/usr/bin/env python3
 
 from pathlib import Path
-from typing import List, Tuple, Dict, Optional
-from collections import defaultdict
+from typing import List, Tuple, Dict, Optional, Iterable, Iterator, TextIO, Collection, NamedTuple, Union
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 import numpy as np
 import logging
 import argparse
 
-# Assume exam_pp.data_model provides these
-from exam_pp.data_model import QueryWithFullParagraphList, GradeFilter, parseQueryWithFullParagraphs
+from feature_schema import CRITERIA, FeatureSchema, MEMO_MAX_ENTRIES, prompt_classes_for_mode
+from ranklib_io import CsrMatrix, csr_from_dense, feature_desc_path, remove_feature_desc, write_feature_desc
+from feature_store import FeatureStoreWriter
+from perf_report import PerfReport
+from judgments_index import iter_indexed_query_grades, parse_shard, read_index, select_entries, JudgementsIndex
+from judgments import (
+    QueryId, DocId, QuestionId, ParagraphGrades, QueryGrades, RatingHistogram, iter_cached_query_grades, read_query_grades,
+    add_to_histogram, read_rating_stats, save_rating_stats, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_BYTES
+)
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Number of queries sent to a worker process at once (--workers)
+QUERIES_PER_TASK = 8
+# Number of query/document pairs whose features are traced at --log-level DEBUG (--debug-sample)
+DEBUG_SAMPLE = 10
 
-# Type definitions
-QueryId = str
-DocId = str
-QuestionId = str
-
-SELF_GRADED = GradeFilter.noFilter()
-SELF_GRADED.is_self_rated = True
-
-def rating_histogram(queries: List[QueryWithFullParagraphList], mode: str = '') -> Dict[QuestionId, Dict[int, int]]:
+def rating_histogram(queries: Iterable[QueryGrades], mode: str = '') -> RatingHistogram:
     """
     Compute histogram of ratings for questions or criteria.
     
     Args:
-        queries: List of QueryWithFullParagraphList objects.
+        queries: Iterable of QueryGrades (see judgments.index_query).
         mode: Feature mode ('nuggets', 'questions', 'multi_criteria', or others).
     """
-    result = defaultdict(lambda: defaultdict(lambda: 0))
+    result: RatingHistogram = {}
     for q in queries:
-        for para in q.paragraphs:
-            for grades in para.retrieve_exam_grade_all(SELF_GRADED):
-                for s in grades.self_ratings or []:
-                    result[QuestionId(s.get_id())][int(s.self_rating)] += 1
-    return dict(result)
+        add_to_histogram(result, q)
+    return result
+
+def load_judgements(
+    path: Path,
+    stream: bool = False,
+    cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+    max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    save_stats_sidecar: bool = False,
+    mode: str = '',
+    lean: bool = False,
+    report: Optional[PerfReport] = None
+) -> Tuple[Iterable[QueryGrades], RatingHistogram]:
+    """
+    Queries of a judgements file plus its rating histogram, so that features can be built
+    in a single traversal of the queries.
+
+    The histogram is gathered while the judgements are ingested into the cache and read
+    back from there (or from a `.stats.json` sidecar next to the judgements file, see
+    judgments.read_rating_stats). Only when no statistics exist yet is it computed
+    separately: from the loaded queries, or with an extra pass when streaming.
 
+    Args:
+        path: Path to the exampp judgements file (JSONL.gz).
+        stream: Return a one-shot stream of queries instead of a list.
+        cache_dir: Judgements cache directory, or None to bypass the cache.
+        max_bytes: Size limit of the judgements cache.
+        save_stats_sidecar: Also write the statistics next to the judgements file.
+        mode: Feature mode, see rating_histogram.
+        lean: Parse the judgements without exam_pp (see judgments.iter_lean_query_grades).
+        report: Timings of the 'parse' and 'histogram' stages are added to it. A stream is
+            timed lazily, so its parse time accumulates while the features are built.
+    """
+    report = report or PerfReport()
+    cache_args = dict(cache_dir=cache_dir, max_bytes=max_bytes, lean=lean)
+    report.count('parse', 'bytes_read', path.stat().st_size)
+    if stream:
+        logging.info(f"Streaming judgements from {path}")
+        with report.stage('histogram'):
+            hist = read_rating_stats(path, cache_dir)
+            if hist is None:
+                logging.info("No rating statistics for the judgements yet, computing them in a separate pass")
+                hist = rating_histogram(iter_cached_query_grades(path, **cache_args), mode=mode)
+                save_rating_stats(path, hist, cache_dir)
+                report.count('histogram', 'bytes_read', path.stat().st_size)
+        queries = report.timed('parse', iter_cached_query_grades(path, **cache_args))
+    else:
+        logging.info(f"Loading judgements from {path}")
+        with report.stage('parse'):
+            queries = read_query_grades(path, **cache_args)
+        logging.info(f"Loaded {len(queries)} queries")
+        with report.stage('histogram'):
+            hist = read_rating_stats(path, cache_dir)
+            if hist is None:
+                hist = rating_histogram(queries, mode=mode)
+                save_rating_stats(path, hist, cache_dir)
+    if save_stats_sidecar:
+        save_rating_stats(path, hist, None, sidecar=True)
+    logging.info(f"Rating statistics for {len(hist)} questions/criteria")
+    return queries, hist
+
+def load_indexed_judgements(
+    path: Path,
+    index: JudgementsIndex,
+    query_ids: Optional[Collection[QueryId]] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    max_query: Optional[int] = None,
+    stream: bool = False,
+    lean: bool = False,
+    report: Optional[PerfReport] = None
+) -> Tuple[Iterable[QueryGrades], RatingHistogram]:
+    """
+    Only the selected queries of an indexed judgements file (see judgments_index.py) plus the
+    rating histogram of the whole file, so their features equal those of a run over all queries.
+    Only the gzip members of the selected queries are read and decompressed.
+
+    Args:
+        path: Path to the indexed judgements file.
+        index: Its index, see judgments_index.read_index.
+        query_ids, shard, max_query: Selection of queries, see judgments_index.select_entries.
+        stream: Return a one-shot stream of queries instead of a list.
+        lean: Parse the judgements without exam_pp (see judgments.lean_query_grades).
+        report: Timing of the 'parse' stage is added to it, see load_judgements.
+    """
+    report = report or PerfReport()
+    entries = select_entries(index, query_ids, shard, max_query)
+    logging.info(f"Reading {len(entries)} of {len(index.entries)} queries from {path} through its index")
+    report.count('parse', 'bytes_read', sum(entry.length for entry in entries))
+    queries = report.timed('parse', iter_indexed_query_grades(path, entries, lean))
+    if not stream:
+        queries = list(queries)
+    return queries, index.histogram
+
+
+def criteria_scores_for_query(
+    q: QueryGrades,
+    max_passage: int = None
+) -> Dict[str, List[Tuple[QueryId, DocId, int]]]:
+    """
+    Collect FourPrompts criterion ratings of a single query.
+
+    Args:
+        q: QueryGrades of the query (see judgments.index_query).
+        max_passage: Maximum number of passages of the query to process.
+    """
+    criteria_scores = defaultdict(list)
+    qid = q.query_id
+    paragraphs = q.paragraphs[:max_passage] if max_passage else q.paragraphs
+    for para in paragraphs:
+        did = para.paragraph_id
+        for crit, s in para.grades.get('FourPrompts', []):  # Match JSON's prompt_class
+            try:
+                rating = int(s)
+                if rating in {0, 1, 2, 3}:
+                    criteria_scores[crit].append((qid, did, rating))
+                else:
+                    logging.warning(f"Invalid rating {rating} for criterion {crit}")
+            except ValueError:
+                logging.warning(f"Invalid rating for criterion {crit}: {s}")
+    return criteria_scores
 
-def save_criteria_run_files(
-    queries: List[QueryWithFullParagraphList],
+def write_criteria_run_lines(
+    criteria_scores: Dict[str, List[Tuple[QueryId, DocId, int]]],
     output_dir: Path,
-    max_query: int = None,
-    max_passage: int = None,
-    criterion: Optional[str] = None
+    run_files: Dict[str, TextIO],
+    line_counts: Dict[str, int],
+    criteria: Optional[Collection[str]] = None
 ):
     """
-    Save TREC run files for criteria in multi_criteria mode, either for a specific criterion or all.
-    
+    Append run lines of one query to the per-criterion run files.
+
+    Run files are opened lazily on the first line of their criterion, so a
+    criterion without any scores never produces a (empty) run file.
+
     Args:
-        queries: List of QueryWithFullParagraphList objects.
+        criteria_scores: Criterion ratings as returned by criteria_scores_for_query.
         output_dir: Directory to save run files (e.g., train/).
-        max_query: Maximum number of queries to process.
-        max_passage: Maximum number of passages per query to process.
-        criterion: Specific criterion to generate run file for (e.g., 'Exactness'), or None for all.
+        run_files: Open run file handles by criterion, updated in place.
+        line_counts: Number of lines written per criterion, updated in place.
+        criteria: Criteria to write (e.g., ['Exactness', 'Coverage']), or None for all.
     """
-    logging.info(f"Saving criteria run files to {output_dir}" + (f" for criterion: {criterion}" if criterion else ""))
-    output_dir.mkdir(parents=True, exist_ok=True)
-    
-    criteria_scores = defaultdict(list)
-    gfilt = GradeFilter.noFilter()
-    gfilt.prompt_class = 'FourPrompts'  # Match JSON's prompt_class
-    
-    queries = queries[:max_query] if max_query else queries
-    for q in queries:
-        qid = QueryId(q.queryId)
-        q.paragraphs = q.paragraphs[:max_passage] if max_passage else q.paragraphs
-        for para in q.paragraphs:
-            did = DocId(para.paragraph_id)
-            grades = para.retrieve_exam_grade_all(gfilt)
-            for grade in grades:
-                for s in grade.self_ratings or []:
-                    crit = s.get_id()
-                    try:
-                        rating = int(s.self_rating)
-                        if rating in {0, 1, 2, 3}:
-                            criteria_scores[crit].append((qid, did, rating))
-                        else:
-                            logging.warning(f"Invalid rating {rating} for criterion {crit}")
-                    except ValueError:
-                        logging.warning(f"Invalid rating for criterion {crit}: {s.self_rating}")
-    
-    if criterion:
-        if criterion not in criteria_scores:
+    for crit, scores in criteria_scores.items():
+        if criteria and crit not in criteria:
+            continue
+        if crit not in run_files:
+            run_files[crit] = (output_dir / f"{crit}.run").open('w')
+            line_counts[crit] = 0
+        run_files[crit].write("".join(f"{qid} 0 {did} 1 {rating} run\n" for qid, did, rating in scores))
+        line_counts[crit] += len(scores)
+
+def close_criteria_run_files(
+    output_dir: Path,
+    run_files: Dict[str, TextIO],
+    line_counts: Dict[str, int],
+    criteria: Optional[Collection[str]] = None
+):
+    """
+    Close run files opened by write_criteria_run_lines and report what was written.
+    """
+    for crit, f in run_files.items():
+        f.close()
+        logging.info(f"Wrote {line_counts[crit]} lines to {output_dir / f'{crit}.run'}")
+    for criterion in criteria or []:
+        if criterion not in run_files:
             logging.error(f"No scores found for criterion {criterion}")
-            return
-        run_file = output_dir / f"{criterion}.run"
-        with run_file.open('w') as f:
-            for qid, did, rating in criteria_scores[criterion]:
-                f.write(f"{qid} 0 {did} 1 {rating} run\n")
-        logging.info(f"Wrote {len(criteria_scores[criterion])} lines to {run_file}")
-    else:
-        for crit, scores in criteria_scores.items():
-            run_file = output_dir / f"{crit}.run"
-            with run_file.open('w') as f:
-                for qid, did, rating in scores:
-                    f.write(f"{qid} 0 {did} 1 {rating} run\n")
-            logging.info(f"Wrote {len(scores)} lines to {run_file}")
 
 def read_qrel(f: Path) -> Dict[Tuple[QueryId, DocId], int]:
     rels = {}
@@ -114,11 +216,193 @@ def read_qrel(f: Path) -> Dict[Tuple[QueryId, DocId], int]:
             except (IndexError, ValueError) as e:
                 logging.error(f"Error processing line: {line.strip()}, error: {e}")
                 continue
-    logging.debug(f"Loaded {len(rels)} relevance labels from {f}")
+    logging.debug("Loaded %d relevance labels from %s", len(rels), f)
     return rels
 
+def ranklib_lines(
+    qid: QueryId,
+    dids: List[DocId],
+    labels: List[int],
+    matrix: np.ndarray,
+    present: np.ndarray,
+    schema: FeatureSchema
+) -> Iterator[str]:
+    """
+    Format the feature matrix of one query as RankLib lines.
+
+    Prompt classes without ratings for a document are left out of its line, and the
+    remaining features are numbered consecutively.
+    """
+    all_present = present.all(axis=1)
+    for did, label, row, row_present, complete in zip(dids, labels, matrix, present, all_present):
+        values = row if complete else row[schema.present_columns(row_present)]
+        feature_str = " ".join(f"{i}:{v}" for i, v in enumerate(values.tolist(), 1))
+        yield f"{label} qid:{qid} {feature_str} # {did}\n"
+
+def sparse_ranklib_lines(
+    qid: QueryId,
+    dids: List[DocId],
+    labels: List[int],
+    features: CsrMatrix
+) -> Iterator[str]:
+    """
+    Format the sparse feature matrix of one query as RankLib/SVMlight lines.
+
+    Only non-zero features are written. Feature ids are the (1-based) schema columns, so
+    they are the same for every document whether or not all prompt classes were rated.
+    """
+    indptr = features.indptr
+    indices = (features.indices + 1).tolist()
+    values = features.data.tolist()
+    for r, (did, label) in enumerate(zip(dids, labels)):
+        start, stop = indptr[r], indptr[r + 1]
+        feature_str = " ".join(f"{i}:{v}" for i, v in zip(indices[start:stop], values[start:stop]))
+        yield f"{label} qid:{qid} {feature_str} # {did}\n"
+
+class TraceSample:
+    """
+    Budget of query/document pairs whose features are logged at DEBUG level (see
+    trace_features). Every worker process gets its own copy of the budget.
+    """
+
+    def __init__(self, n: int = DEBUG_SAMPLE):
+        self.remaining = n
+
+    def take(self, n: int) -> int:
+        """Number of the next `n` pairs to trace; 0 unless DEBUG logging is enabled."""
+        if self.remaining <= 0 or not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return 0
+        taken = min(n, self.remaining)
+        self.remaining -= taken
+        return taken
+
+def trace_features(qid: QueryId, para: ParagraphGrades, label: int, row: np.ndarray, row_present: np.ndarray,
+                   schema: FeatureSchema):
+    """Log the self-ratings and the feature vector (as written to the RankLib file) of one document."""
+    did = para.paragraph_id
+    for pclass, ratings in para.grades.items():
+        logging.debug(f"Self-ratings for qid:{qid}, did:{did}, prompt class {pclass}: {ratings}")
+    columns = schema.present_columns(row_present)
+    values, feature_desc = row[columns], schema.present_desc(row_present)
+    logging.debug(f"Final feature vector for qid:{qid}, did:{did} ({len(values)} features):")
+    for i, (val, desc) in enumerate(zip(values.tolist(), feature_desc)):
+        logging.debug(f"  {i+1}: {val} ({desc})")
+    logging.debug(f"Relevance label: {label}")
+
+class QueryFeatures(NamedTuple):
+    """Output of query_features for one query."""
+    qid: QueryId
+    lines: str                    # RankLib lines
+    criteria_scores: Dict[str, List[Tuple[QueryId, DocId, int]]]
+    dids: List[DocId]             # documents with at least one feature
+    labels: List[int]
+    features: Optional[Union[np.ndarray, CsrMatrix]]  # schema-wide rows of `dids`, if requested
+
+def query_features(
+    q: QueryGrades,
+    schema: FeatureSchema,
+    mean_rating: Dict[QuestionId, float],
+    hist: Dict[QuestionId, Dict[int, int]],
+    rels: Dict[Tuple[QueryId, DocId], int],
+    max_passage: int = None,
+    with_criteria: bool = False,
+    sparse: bool = False,
+    with_matrix: bool = False,
+    trace: Optional[TraceSample] = None
+) -> QueryFeatures:
+    """
+    Build the RankLib lines and (optionally) the criteria scores and feature matrix of a single query.
+
+    Only depends on its arguments, so queries can be processed in any process once the
+    global rating statistics are known. Documents without any rated prompt class are
+    skipped with a warning. The features of the first documents are logged while `trace`
+    has budget left.
+    """
+    qid = q.query_id
+    logging.debug("Processing query: %s", qid)
+    paragraphs = q.paragraphs[:max_passage] if max_passage else q.paragraphs
+    criteria_scores = criteria_scores_for_query(q, max_passage) if with_criteria else {}
+    matrix, present = schema.build_matrix([para.grades for para in paragraphs], mean_rating, hist)
+    keep = present.any(axis=1)
+    for para, row_present, kept in zip(paragraphs, present, keep):
+        if not kept:
+            logging.warning(f"No features for qid:{qid}, did:{para.paragraph_id}, skipping document")
+            continue
+        for layout, found in zip(schema.layouts, row_present):
+            if not found:
+                logging.warning(f"    No ratings found for prompt class {layout.pclass} (qid:{qid}, did:{para.paragraph_id})")
+    if not keep.all():
+        paragraphs = [para for para, kept in zip(paragraphs, keep) if kept]
+        matrix, present = matrix[keep], present[keep]
+    dids = [para.paragraph_id for para in paragraphs]
+    labels = [rels.get((qid, did), 0) for did in dids]
+    for i in range(trace.take(len(dids)) if trace else 0):
+        trace_features(qid, paragraphs[i], labels[i], matrix[i], present[i], schema)
+
+    features = None
+    if sparse:
+        features = csr_from_dense(matrix)
+        lines = "".join(sparse_ranklib_lines(qid, dids, labels, features))
+    else:
+        features = matrix
+        lines = "".join(ranklib_lines(qid, dids, labels, matrix, present, schema))
+    return QueryFeatures(qid, lines, criteria_scores, dids, labels, features if with_matrix else None)
+
+# Arguments of query_features shared by all queries, set once per worker process
+_worker_context = None
+
+def _init_feature_worker(context: dict):
+    global _worker_context
+    _worker_context = context
+
+def _query_features_chunk(chunk: List[QueryGrades]) -> Tuple[List[QueryFeatures], Tuple[int, int]]:
+    """Features of a chunk of queries, plus the feature memo hits and misses they caused in this worker."""
+    memo = _worker_context['schema'].memo
+    hits, misses = memo.hits, memo.misses
+    results = [query_features(q, **_worker_context) for q in chunk]
+    return results, (memo.hits - hits, memo.misses - misses)
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def iter_query_features(
+    queries: Iterable[QueryGrades],
+    context: dict,
+    workers: int = 1
+) -> Iterator[QueryFeatures]:
+    """
+    Yield query_features(q, **context) for every query, in the order of `queries`.
+
+    With more than one worker, chunks of queries are sharded across a process pool. At most
+    a few chunks per worker are in flight, so a streamed input is still consumed lazily,
+    and results are yielded in submission order, keeping the output byte-identical. The
+    feature memo counters of the workers are added to those of `context['schema']`.
+    """
+    if workers <= 1:
+        for q in queries:
+            yield query_features(q, **context)
+        return
+
+    memo = context['schema'].memo
+
+    def collect(future) -> List[QueryFeatures]:
+        results, counts = future.result()
+        memo.record(*counts)
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_feature_worker, initargs=(context,)) as pool:
+        pending = deque()
+        for chunk in chunked(queries, QUERIES_PER_TASK):
+            pending.append(pool.submit(_query_features_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from collect(pending.popleft())
+        while pending:
+            yield from collect(pending.popleft())
+
 def save_ranklib_features(
-    queries: List[QueryWithFullParagraphList],
+    queries: Iterable[QueryGrades],
     qrel_path: Path,
     output_path: Path,
     mode: str = '',
@@ -126,13 +410,27 @@ def save_ranklib_features(
     max_query: int = None,
     max_passage: int = None,
     criteria_run_dir: Optional[Path] = None,
-    criterion: Optional[str] = None
+    criteria: Optional[Collection[str]] = None,
+    hist: Optional[Dict[QuestionId, Dict[int, int]]] = None,
+    workers: int = 1,
+    sparse: bool = False,
+    store_dir: Optional[Path] = None,
+    memo_size: int = MEMO_MAX_ENTRIES,
+    debug_sample: int = DEBUG_SAMPLE,
+    report: Optional[PerfReport] = None
 ):
     """
     Save feature vectors in RankLib format with mode-based feature selection and debugging.
+
+    Queries are processed one at a time: the RankLib lines and criteria run lines of a
+    query are written before the next query is touched. When `hist` is given, `queries`
+    is only iterated once, so it may be a stream such as judgments.iter_cached_query_grades().
+
+    Ratings are looked up in the per-paragraph prompt class index of QueryGrades, which
+    is shared with rating_histogram and the criteria run files.
     
     Args:
-        queries: List of QueryWithFullParagraphList objects.
+        queries: Iterable of QueryGrades (see judgments.index_query).
         qrel_path: Path to qrel file with relevance labels.
         output_path: Path to save RankLib feature file.
         mode: Feature mode ('nuggets', 'questions', 'multi_criteria', 'all_rubric_concat', or '' for default).
@@ -140,165 +438,104 @@ def save_ranklib_features(
         max_query: Maximum number of queries to process.
         max_passage: Maximum number of passages per query to process.
         criteria_run_dir: Directory to save criteria run files (for multi_criteria mode).
-        criterion: Specific criterion to generate run file for (e.g., 'Exactness'), or None for all.
+        criteria: Criteria to generate run files for (e.g., ['Exactness', 'Coverage']), or None for all.
+            All criterion run files are produced from the same pass as the RankLib file.
+        hist: Precomputed rating histogram (see rating_histogram); computed from `queries` if None.
+        workers: Number of worker processes building features; output is identical to workers=1.
+        sparse: Write only non-zero features, numbered by schema column, and the feature
+            descriptions to a `.features` sidecar (see ranklib_io.read_ranklib).
+        store_dir: Also write the features, labels, query and doc ids as memory-mappable
+            `.npy` arrays to this directory (see feature_store.open_feature_store); the
+            matrix is sparse (CSR) when `sparse` is set.
+        memo_size: Number of rating patterns whose feature columns are memoized (see
+            feature_schema.FeatureMemo), per worker process; 0 disables the memo.
+        debug_sample: Number of query/document pairs whose ratings and features are
+            logged when DEBUG logging is enabled, per worker process.
+        report: Timings and counters of the 'qrels', 'histogram', 'features' and 'write'
+            stages are added to it (see perf_report.PerfReport).
     """
+    report = report or PerfReport()
     logging.info(f"Processing queries with mode: '{mode}', use_one_hot: {use_one_hot}")
     
     # Save criteria run files if in multi_criteria mode and directory is specified
-    if mode == 'multi_criteria' and criteria_run_dir:
-        save_criteria_run_files(queries, criteria_run_dir, max_query, max_passage, criterion)
+    save_criteria = mode == 'multi_criteria' and criteria_run_dir
+    if save_criteria:
+        logging.info(f"Saving criteria run files to {criteria_run_dir}" + (f" for criteria: {list(criteria)}" if criteria else ""))
+        criteria_run_dir.mkdir(parents=True, exist_ok=True)
+    criteria_run_files = {}
+    criteria_line_counts = {}
     
-    # Define prompt classes based on mode
-    PROMPT_CLASSES = {}
-    if mode == 'nuggets':
-        PROMPT_CLASSES['NuggetSelfRatedPrompt'] = {0, 1, 2, 3, 4, 5}
-    elif mode == 'questions':
-        PROMPT_CLASSES['QuestionSelfRatedUnanswerablePromptWithChoices'] = {0, 1, 2, 3, 4, 5}
-    elif mode == 'multi_criteria':
-        PROMPT_CLASSES['FourPrompts'] = {0, 1, 2, 3}
-    else:  # mode == 'all_rubric_concat' or default
-        PROMPT_CLASSES['NuggetSelfRatedPrompt'] = {0, 1, 2, 3, 4, 5}
-        PROMPT_CLASSES['QuestionSelfRatedUnanswerablePromptWithChoices'] = {0, 1, 2, 3, 4, 5}
-        PROMPT_CLASSES |= {
-            'FagB': {0, 1},
-            'FagB_few': {0, 1},
-            'HELM': {0, 1},
-            'Sun': {0, 1},
-            'Sun_few': {0, 1},
-            'Thomas': {0, 1, 2},
-        }
-    logging.info(f"Using prompt classes: {list(PROMPT_CLASSES.keys())}")
+    # Define prompt classes based on mode and fix the feature layout once
+    PROMPT_CLASSES = prompt_classes_for_mode(mode)
+    schema = FeatureSchema(PROMPT_CLASSES, mode=mode, use_one_hot=use_one_hot, memo_size=memo_size)
+    logging.info(f"Using prompt classes: {list(PROMPT_CLASSES.keys())} ({schema.n_features} features)")
 
     # Load relevance labels
-    rels = read_qrel(qrel_path)
+    with report.stage('qrels'):
+        rels = read_qrel(qrel_path)
+    report.count('qrels', 'bytes_read', qrel_path.stat().st_size)
 
     # Compute rating histogram for sorting
-    hist = rating_histogram(queries, mode=mode)
+    if hist is None:
+        with report.stage('histogram'):
+            queries = list(queries)
+            hist = rating_histogram(queries, mode=mode)
     mean_rating = {
         qid: sum(n * r for r, n in ratings.items()) / sum(ratings.values())
         for qid, ratings in hist.items() if sum(ratings.values()) > 0
     }
-    logging.debug(f"Computed histogram for {len(hist)} questions/criteria, mean ratings for {len(mean_rating)} items")
-    queries = queries[:max_query] if max_query else queries
-    with output_path.open('w') as f:
-        for q in queries:
-            qid = QueryId(q.queryId)
-            logging.debug(f"Processing query: {qid}")
-            q.paragraphs = q.paragraphs[:max_passage] if max_passage else q.paragraphs
-            for para in q.paragraphs:
-                did = DocId(para.paragraph_id)
-                logging.debug(f"Processing document: {did} for query: {qid}")
-                feats = []
-                feature_desc = []
-
-                for pclass, valid_range in PROMPT_CLASSES.items():
-                    gfilt = GradeFilter.noFilter()
-                    gfilt.prompt_class = pclass
-                    logging.debug(f"  Prompt class: {pclass}, valid ratings: {valid_range}")
-
-                    grades = para.retrieve_exam_grade_all(gfilt)
-                    ratings = [
-                        (QuestionId(s.get_id()), s.self_rating)
-                        for grade in grades
-                        for s in (grade.self_ratings or [])
-                        # if mode != 'multi_criteria' or (criterion is None or s.get_id() == criterion)
-                    ]
-                    logging.debug(f"    Processed ratings: {ratings}")
-
-                    if not ratings:
-                        logging.warning(f"    No ratings found for prompt class {pclass}")
-                        continue
-
-                    expected_ratings = 10 if pclass in {'NuggetSelfRatedPrompt', 'QuestionSelfRatedUnanswerablePromptWithChoices'} else 4 if pclass == 'FourPrompts' else 1
-
-                    def clamp(x: int) -> int:
-                        return 0 if x not in valid_range else x
-
-                    def one_hot_rating(n: int):
-                        x = np.zeros(max(valid_range) + 1)
-                        x[clamp(n)] = 1
-                        return x
-
-                    def rating_feature(sort_key, encoding, desc_prefix):
-                        sorted_ratings = sorted(ratings, key=sort_key, reverse=True)
-                        padded_ratings = (
-                            [clamp(rating) for _, rating in sorted_ratings][:expected_ratings] +
-                            [0] * (expected_ratings - len(ratings))
-                        )
-                        logging.debug(f"    {desc_prefix} ratings: {padded_ratings}")
-                        return [encoding(rating) for rating in padded_ratings], [
-                            f"{desc_prefix}_{i}" for i in range(expected_ratings)
-                        ]
-
-                    if len(valid_range) <= 3 and pclass != 'FourPrompts':
-                        r = clamp(ratings[0][1])
-                        feats.append(np.array([r]))
-                        feature_desc.append(f"{pclass}_integer_rating")
-                        logging.debug(f"    Added {pclass} integer rating: {r}")
-                        if (mode == 'all_rubric_concat' or mode == '') and use_one_hot:
-                            feats.append(one_hot_rating(r))
-                            feature_desc.append(f"{pclass}_one_hot_{r}")
-                            logging.debug(f"    Added {pclass} one-hot: {one_hot_rating(r)}")
-                    else:
-                        feat, d = rating_feature(
-                            sort_key=lambda q: mean_rating.get(q[0], 0),
-                            encoding=lambda x: np.array([x]),
-                            desc_prefix=f"{pclass}_int_mean_rating"
-                        )
-                        feats += feat
-                        feature_desc += d
-
-                        if (mode in {'all_rubric_concat', '', 'multi_criteria'} or pclass == 'FourPrompts') and use_one_hot:
-                            feat, d = rating_feature(
-                                sort_key=lambda q: mean_rating.get(q[0], 0),
-                                encoding=one_hot_rating,
-                                desc_prefix=f"{pclass}_one_hot_mean_rating"
-                            )
-                            feats += feat
-                            feature_desc += [f"{desc}_{j}" for desc in d for j in range(max(valid_range) + 1)]
-
-                            if pclass != 'FourPrompts':
-                                feat, d = rating_feature(
-                                    sort_key=lambda q: hist.get(q[0], {}).get(4, 0) + hist.get(q[0], {}).get(5, 0),
-                                    encoding=one_hot_rating,
-                                    desc_prefix=f"{pclass}_one_hot_informativeness"
-                                )
-                                feats += feat
-                                feature_desc += [f"{desc}_{j}" for desc in d for j in range(max(valid_range) + 1)]
-
-                        feat, d = rating_feature(
-                            sort_key=lambda q: q[1],
-                            encoding=lambda x: np.array([x]),
-                            desc_prefix=f"{pclass}_int_rating"
+    logging.debug("Computed histogram for %d questions/criteria, mean ratings for %d items", len(hist), len(mean_rating))
+    context = dict(
+        schema=schema, mean_rating=mean_rating, hist=hist, rels=rels,
+        max_passage=max_passage, with_criteria=bool(save_criteria), sparse=sparse,
+        with_matrix=store_dir is not None, trace=TraceSample(debug_sample)
+    )
+    if sparse:
+        write_feature_desc(output_path, schema.feature_desc)
+    else:
+        remove_feature_desc(output_path)
+    if workers > 1:
+        logging.info(f"Building features with {workers} worker processes")
+    store = FeatureStoreWriter(store_dir, schema.feature_desc, schema.dtype, sparse=sparse) if store_dir else None
+    # Streamed queries are parsed while results are pulled: that time goes to 'parse', not 'features'
+    parse_seconds = report.seconds.get('parse', 0.0)
+    try:
+        with output_path.open('w') as f:
+            results = iter_query_features(islice(queries, max_query or None), context, workers)
+            for result in report.timed('features', results):
+                report.count('features', 'queries')
+                report.count('features', 'docs', len(result.dids))
+                with report.stage('write'):
+                    if save_criteria:
+                        write_criteria_run_lines(
+                            result.criteria_scores, criteria_run_dir,
+                            criteria_run_files, criteria_line_counts, criteria
                         )
-                        feats += feat
-                        feature_desc += d
-
-                        if (mode in {'all_rubric_concat', '', 'multi_criteria'} or pclass == 'FourPrompts') and use_one_hot:
-                            feat, d = rating_feature(
-                                sort_key=lambda q: q[1],
-                                encoding=one_hot_rating,
-                                desc_prefix=f"{pclass}_one_hot_rating"
-                            )
-                            feats += feat
-                            feature_desc += [f"{desc}_{j}" for desc in d for j in range(max(valid_range) + 1)]
-
-                        counts = [sum(1 for _, r in ratings if r >= n) for n in range(max(valid_range))]
-                        feats += [np.array([c]) for c in counts]
-                        feature_desc += [f"{pclass}_count_geq_{n}" for n in range(max(valid_range))]
-                        logging.debug(f"    Added {pclass} counts: {counts}")
-
-                feature_vector = np.hstack(feats)
-                logging.debug(f"Final feature vector for qid:{qid}, did:{did} ({len(feature_vector)} features):")
-                for i, (val, desc) in enumerate(zip(feature_vector, feature_desc)):
-                    logging.debug(f"  {i+1}: {val} ({desc})")
-
-                label = rels.get((qid, did), 0)
-                logging.debug(f"Relevance label: {label}")
-
-                feature_str = " ".join(f"{i+1}:{v}" for i, v in enumerate(feature_vector))
-                f.write(f"{label} qid:{qid} {feature_str} # {did}\n")
-                logging.debug(f"Wrote RankLib line: {label} qid:{qid} ... # {did}")
+                    if store:
+                        store.add(result.qid, result.dids, result.labels, result.features)
+                    f.write(result.lines)
+        if store:
+            with report.stage('write'):
+                store.close()
+        memo = schema.memo
+        logging.info(f"Feature memo: {memo.hits} hits, {memo.misses} misses ({memo.hit_rate:.1%} hit rate)")
+    finally:
+        if store:
+            # Leaves the previous store in place if writing failed
+            store.abort()
+        if save_criteria:
+            close_criteria_run_files(criteria_run_dir, criteria_run_files, criteria_line_counts, criteria)
+    report.add_time('features', parse_seconds - report.seconds.get('parse', 0.0))
+    report.count('features', 'memo_hits', schema.memo.hits)
+    report.count('features', 'memo_misses', schema.memo.misses)
+
+    written = [output_path] + [Path(run_file.name) for run_file in criteria_run_files.values()]
+    if sparse:
+        written.append(feature_desc_path(output_path))
+    if store:
+        written += store.paths
+    report.count('write', 'bytes_written', sum(path.stat().st_size for path in written))
+
 def main():
     parser = argparse.ArgumentParser(description="Save features in RankLib format with mode-based selection")
     parser.add_argument('--judgements', '-j', type=Path, required=True, help='exampp judgements file (JSONL.gz)')
@@ -306,21 +543,70 @@ def main():
     parser.add_argument('--output', '-o', type=Path, required=True, help='Output RankLib feature file')
     parser.add_argument('--mode', type=str, default='', choices=['', 'nuggets', 'questions', 'all_rubric_concat', 'multi_criteria'],
                         help='Feature mode: nuggets, questions, multi_criteria, all_rubric_concat, or empty for default')
-    parser.add_argument('--criterion', type=str, required=False, choices=['Exactness', 'Topicality', 'Coverage', 'Contextual Fit'],
-                        help='Specific criterion to generate run file for (multi_criteria mode only)')
+    parser.add_argument('--criterion', type=str, nargs='+', required=False, choices=CRITERIA + ['all'],
+                        help="Criteria to generate run files for, or 'all' (multi_criteria mode only). "
+                             "All run files and the RankLib file are written from a single pass over the judgements")
     parser.add_argument('--criteria-run-dir', type=Path, required=False, help='Directory to save criteria run files (multi_criteria mode)')
     parser.add_argument('--max-query', type=int, required=False, help='Max number of queries to process')
     parser.add_argument('--max-passage', type=int, required=False, help='Max number of passages to process')
     parser.add_argument('--no-one-hot', action='store_false', dest='use_one_hot', help='Disable one-hot encodings')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for feature building (output is identical for any value)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Write only non-zero features (RankLib/SVMlight) plus a <output>.features description sidecar')
+    parser.add_argument('--store-dir', type=Path, required=False,
+                        help='Also write the features as memory-mappable .npy arrays (plus labels, qids, doc ids and feature names) to this directory')
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR,
+                        help='Cache of pre-extracted judgements, keyed by the content hash of the judgements file')
+    parser.add_argument('--cache-max-bytes', type=int, default=DEFAULT_CACHE_MAX_BYTES,
+                        help='Size limit of the judgements cache; least recently used entries are evicted')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the judgements file, bypassing the cache')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read judgements one query at a time instead of loading them all into memory '
+                             '(a single pass once the rating statistics of the file are known)')
+    parser.add_argument('--save-stats-sidecar', action='store_true',
+                        help='Write the rating statistics to <judgements>.stats.json, where later runs find them even without the cache')
+    parser.add_argument('--memo-size', type=int, default=MEMO_MAX_ENTRIES,
+                        help=f'Rating patterns whose feature columns are memoized per process (default: {MEMO_MAX_ENTRIES}, 0 disables)')
+    parser.add_argument('--lean-reader', action='store_true',
+                        help='Parse the judgements with the lean JSON reader instead of the exam_pp data model (same features, faster)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Logging verbosity (default: INFO)')
+    parser.add_argument('--debug-sample', type=int, default=DEBUG_SAMPLE,
+                        help=f'Query/document pairs whose ratings and features are logged at --log-level DEBUG (default: {DEBUG_SAMPLE})')
+    parser.add_argument('--report', type=Path, required=False,
+                        help='Write per-stage timings and counters (docs/sec, bytes read/written, peak RSS) to this JSON file')
+    parser.add_argument('--query-ids', type=str, nargs='+', required=False,
+                        help='Only build features for these queries (needs an index, see judgments_index.py)')
+    parser.add_argument('--shard', type=parse_shard, required=False, metavar='i/N',
+                        help='Only build features for the i-th of N contiguous parts of the queries (needs an index, see judgments_index.py)')
     args = parser.parse_args()
 
-    logging.info(f"Loading judgements from {args.judgements}")
-    queries = parseQueryWithFullParagraphs(args.judgements)
-    logging.info(f"Loaded {len(queries)} queries")
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    report = PerfReport()
+    criteria = None if args.criterion is None or 'all' in args.criterion else args.criterion
+    index = read_index(args.judgements)
+    if index is None and (args.query_ids or args.shard):
+        parser.error(f"--query-ids and --shard need an indexed judgements file: run judgments_index.py -j {args.judgements}")
+    if index is not None and (args.query_ids or args.shard or args.max_query):
+        queries, hist = load_indexed_judgements(
+            args.judgements, index, query_ids=args.query_ids, shard=args.shard, max_query=args.max_query,
+            stream=args.stream, lean=args.lean_reader, report=report
+        )
+    else:
+        queries, hist = load_judgements(
+            args.judgements, stream=args.stream, cache_dir=None if args.no_cache else args.cache_dir,
+            max_bytes=args.cache_max_bytes, save_stats_sidecar=args.save_stats_sidecar, mode=args.mode,
+            lean=args.lean_reader, report=report
+        )
     save_ranklib_features(
         queries, args.qrel, args.output, mode=args.mode, use_one_hot=args.use_one_hot,
         max_query=args.max_query, max_passage=args.max_passage,
-        criteria_run_dir=args.criteria_run_dir, criterion=args.criterion
+        criteria_run_dir=args.criteria_run_dir, criteria=criteria, hist=hist, workers=args.workers, sparse=args.sparse,
+        store_dir=args.store_dir, memo_size=args.memo_size, debug_sample=args.debug_sample, report=report
     )
+    if args.report:
+        report.write(args.report)
+        logging.info(f"Wrote performance report to {args.report}")
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -22,44 +22,12 @@ f_v_output='./feature_vectors/flant5_dl23.ranklib'
 # qrel='/home/nf1104/work/data/dl/data/dl2020/2020qrels-pass.txt'
 qrel='/home/nf1104/work/data/dl/data/dl2023/converted/new_qrels.txt'
 
+# All four criterion run files and the RankLib file come from a single pass over $input
 python3 build_feature_vectors.py \
 --judgements $input \
 --qrel $qrel \
 --output $f_v_output \
---criteria-run-dir ./feature_vectors/ \
 --mode multi_criteria \
 --criteria-run-dir $o_path \
---criterion Exactness \
---no-one-hot \
-
-python3 build_feature_vectors.py \
---judgements $input \
---qrel $qrel \
---output $f_v_output \
---criteria-run-dir ./feature_vectors/ \
---mode multi_criteria \
---criteria-run-dir $o_path \
---criterion Coverage \
---no-one-hot \
-
-
-python3 build_feature_vectors.py \
---judgements $input \
---qrel $qrel \
---output $f_v_output \
---criteria-run-dir ./feature_vectors/ \
---mode multi_criteria \
---criteria-run-dir $o_path \
---criterion Topicality \
---no-one-hot \
-
-python3 build_feature_vectors.py \
---judgements $input \
---qrel $qrel \
---output $f_v_output \
---criteria-run-dir ./feature_vectors/ \
---mode multi_criteria \
---criteria-run-dir $o_path \
---criterion 'Contextual Fit' \
---no-one-hot \
-
+--criterion Exactness Coverage Topicality 'Contextual Fit' \
+--no-one-hot
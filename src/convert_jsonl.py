@@ -1,63 +1,164 @@
 import json
+import gzip
 import argparse
+from collections import defaultdict
+from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-##-----ENDED UP NOT USING THIS FILE CONVERSION AT ALL------
+# Buffered run lines (in characters, over all methods) before they are appended to the run files
+FLUSH_CHARS = 8 * 1024 * 1024
 
-def convert(input_json_file, output_json_file):
-    with open(input_json_file, 'r') as f:
-        lines = f.readlines()
 
-    with open(output_json_file, 'w') as out_file:
-        for i, line in enumerate(lines):
-            line = line.strip()
-            if not line:
-                continue  # Skip empty lines
+def open_judgements(path: Path):
+    """Open a judgements JSONL file for reading lines as bytes, gzip-compressed or not."""
+    with path.open('rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if compressed else path.open('rb')
 
-            try:
-                query_data = json.loads(line)
-            except json.JSONDecodeError as e:
-                print(f"[Warning] Skipping line {i + 1} due to JSON error: {e}")
-                continue
 
-            if not isinstance(query_data, list) or len(query_data) != 2:
-                print(f"[Warning] Unexpected format on line {i + 1}, skipping.")
-                continue
+def run_file_name(method: str) -> str:
+    return method.replace('/', '_') + '.run'
+
+
+class RunWriter:
+    """
+    Appends the lines of many TREC run files (one per ranking method) from buffers.
+
+    Lines are collected per method and appended to their files in bulk once FLUSH_CHARS
+    are buffered, so only the buffers are held in memory and at most one file is open
+    at a time, however many methods there are. Methods whose file names collide (e.g.
+    'a/b' and 'a_b') get numbered file names, so that their runs stay apart.
+    """
 
-            query_id = query_data[0]
-            paragraphs = query_data[1]
+    def __init__(self, output_dir: Path, flush_chars: int = FLUSH_CHARS):
+        self.output_dir = output_dir
+        self.flush_chars = flush_chars
+        self.buffers = defaultdict(list)
+        self.buffered = 0
+        self.line_counts = defaultdict(int)
+        self.file_names = {}
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    def file_name(self, method: str) -> str:
+        """Run file name of a method, unique among the methods seen so far."""
+        if method not in self.file_names:
+            name = run_file_name(method)
+            stem = name[:-len('.run')]
+            taken = set(self.file_names.values())
+            n = 1
+            while name in taken:
+                n += 1
+                name = f"{stem}_{n}.run"
+            if n > 1:
+                print(f"[Warning] Run file name of method {method!r} collides with another method, writing {name}")
+            self.file_names[method] = name
+            # Truncate run files of a previous conversion
+            (self.output_dir / name).open('w').close()
+        return self.file_names[method]
+
+    def add(self, method: str, lines: list):
+        self.file_name(method)
+        self.buffers[method] += lines
+        self.line_counts[method] += len(lines)
+        self.buffered += sum(len(line) for line in lines)
+        if self.buffered >= self.flush_chars:
+            self.flush()
+
+    def flush(self):
+        for method, lines in self.buffers.items():
+            with (self.output_dir / self.file_names[method]).open('a') as out_file:
+                out_file.writelines(lines)
+        self.buffers.clear()
+        self.buffered = 0
+
+
+def iter_queries(path: Path):
+    """Yield (line number, decoded query) for every line of a judgements file, one at a time."""
+    loads = orjson.loads if orjson is not None else json.loads
+    with open_judgements(path) as f:
+        try:
+            for i, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue  # Skip empty lines
 
-            for paragraph in paragraphs:
                 try:
-                    paragraph_id = paragraph['paragraph_id']
-                    rankings = paragraph['paragraph_data']['rankings']
-                except KeyError as e:
-                    print(f"[Warning] Missing expected key in paragraph on line {i + 1}: {e}")
+                    query_data = loads(line)
+                except ValueError as e:
+                    print(f"[Warning] Skipping line {i + 1} due to JSON error: {e}")
                     continue
 
-                for ranking in rankings:
-                    try:
-                        rank = ranking['rank']
-                        score = ranking['score']
-                        method = ranking['method']
-                    except KeyError as e:
-                        print(f"[Warning] Missing ranking key in line {i + 1}: {e}")
-                        continue
-
-                    run_entry = {
-                        "query_id": query_id,
-                        "document_id": paragraph_id,
-                        "rank": rank,
-                        "score": score,
-                        "method": method
-                    }
-                    out_file.write(json.dumps(run_entry) + "\n")
+                if not isinstance(query_data, list) or len(query_data) != 2:
+                    print(f"[Warning] Unexpected format on line {i + 1}, skipping.")
+                    continue
+                yield i, query_data
+        except EOFError as e:
+            print(f"[Warning] Truncated input file, keeping the queries read so far: {e}")
+
+
+def query_run_lines(i, query_data):
+    """TREC run lines of one query per ranking method, each ordered by rank (ties by descending score)."""
+    query_id = query_data[0]
+    paragraphs = query_data[1]
+    method_rankings = defaultdict(list)
+
+    for paragraph in paragraphs:
+        try:
+            paragraph_id = paragraph['paragraph_id']
+            rankings = paragraph['paragraph_data']['rankings']
+        except (KeyError, TypeError) as e:
+            print(f"[Warning] Missing or malformed key in paragraph on line {i + 1}: {e!r}")
+            continue
+
+        for ranking in rankings or []:
+            try:
+                rank = ranking['rank']
+                score = ranking['score']
+                method = ranking['method']
+                entry = (rank, -score, paragraph_id, score)
+            except (KeyError, TypeError) as e:
+                # TypeError: a null ranking, or a null or non-numeric score
+                print(f"[Warning] Missing or malformed ranking key in line {i + 1}: {e!r}")
+                continue
+            method_rankings[method].append(entry)
+
+    run_lines = {}
+    for method, entries in method_rankings.items():
+        entries.sort()
+        run_lines[method] = [
+            f"{query_id} Q0 {paragraph_id} {rank} {score} {method}\n"
+            for rank, _, paragraph_id, score in entries
+        ]
+    return run_lines
+
+
+def convert(input_json_file, output_dir, flush_chars=FLUSH_CHARS):
+    """
+    Write one TREC run file (`<qid> Q0 <docid> <rank> <score> <method>`) per ranking method
+    from the `paragraph_data.rankings` of a judgements file, in a single streaming pass.
+
+    Only one query is decoded at a time, and run lines are written in bulk (see RunWriter).
+    Returns the number of lines written per run file name.
+    """
+    writer = RunWriter(Path(output_dir), flush_chars)
+    for i, query_data in iter_queries(Path(input_json_file)):
+        for method, lines in query_run_lines(i, query_data).items():
+            writer.add(method, lines)
+    writer.flush()
+    return {writer.file_names[method]: count for method, count in writer.line_counts.items()}
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Convert JSONL with full data to TREC run format")
-    parser.add_argument('-input', required=True, help='Path to input JSONL file with rankings')
-    parser.add_argument('-output', required=True, help='Path to output JSONL file in run format')
+    parser = argparse.ArgumentParser(description="Convert the rankings in a judgements JSONL(.gz) file to TREC run files, one per ranking method")
+    parser.add_argument('--input', '-input', required=True, help='Path to input JSONL or JSONL.gz judgements file with rankings')
+    parser.add_argument('--output-dir', '-output', required=True, help='Directory for the <method>.run files')
+    parser.add_argument('--flush-chars', type=int, default=FLUSH_CHARS, help='Buffered run lines (in characters) before they are written')
     args = parser.parse_args()
-    
-    convert(input_json_file=args.input, output_json_file=args.output)
+
+    line_counts = convert(input_json_file=args.input, output_dir=args.output_dir, flush_chars=args.flush_chars)
+    for name, count in sorted(line_counts.items()):
+        print(f"{name}: {count} lines")
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import argparse
+import logging
+import numpy as np
+
+from run_io import Run, RunVocab, read_run
+from ranklib_io import read_ranklib
+from feature_store import open_feature_store
+
+# Name of the base system's score among the features, as in the Rank-LiPS setup
+ORIG_SCORE = 'OrigScore'
+# Value of features that are missing for a document (Rank-LiPS --default-any-feature-value)
+DEFAULT_FEATURE_VALUE = -99.0
+
+class JoinedSystem(NamedTuple):
+    """Documents of one base run with their features: rows grouped by query, in the base run's order."""
+    run: Run                  # base run (qid, docid and score of every row)
+    features: np.ndarray      # (rows, features), OrigScore first, missing values defaulted
+    feature_names: List[str]
+
+class JoinedCodes(NamedTuple):
+    """
+    A JoinedSystem as returned by a worker process: ids as codes into the labels of just
+    the ids the system uses, instead of the worker's vocabulary of all systems it joined.
+    """
+    qids: np.ndarray          # row -> index into qid_labels
+    docids: np.ndarray        # row -> index into docid_labels
+    qid_labels: List[str]
+    docid_labels: List[str]
+    scores: np.ndarray
+    features: np.ndarray
+    feature_names: List[str]
+
+    @classmethod
+    def from_joined(cls, joined: JoinedSystem) -> 'JoinedCodes':
+        run = joined.run
+        qid_codes, qids = np.unique(run.qids, return_inverse=True)
+        docid_codes, docids = np.unique(run.docids, return_inverse=True)
+        return cls(qids.astype(np.int32), docids.astype(np.int32), run.vocab.qids.decode(qid_codes),
+                   run.vocab.docids.decode(docid_codes), run.scores, joined.features, joined.feature_names)
+
+    def to_joined(self, vocab: RunVocab) -> JoinedSystem:
+        """The joined system with its ids interned into `vocab`."""
+        run = Run(vocab, vocab.qids.encode(self.qid_labels)[self.qids], vocab.docids.encode(self.docid_labels)[self.docids],
+                  self.scores, np.zeros(len(self.qids), dtype=np.int32))
+        return JoinedSystem(run, self.features, self.feature_names)
+
+class FeatureIndex:
+    """
+    Feature vectors looked up by (qid, docid): the criterion run files of build_feature_vectors.py
+    (one feature per run, its score; see from_runs) or its feature store / RankLib output
+    (see from_features).
+    """
+
+    def __init__(self, vocab: RunVocab, qids: np.ndarray, docids: np.ndarray, features: np.ndarray, feature_names: List[str]):
+        keys = (qids.astype(np.int64) << 32) | docids.astype(np.int64)
+        self.vocab = vocab
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.features = features
+        self.feature_names = list(feature_names)
+
+    @classmethod
+    def from_runs(cls, paths: List[Path], vocab: RunVocab, default: float = DEFAULT_FEATURE_VALUE) -> 'FeatureIndex':
+        """One feature per run file (named after the file), `default` where a run lacks a document."""
+        runs = [read_run(path, vocab).dedupe() for path in paths]
+        keys = np.unique(np.concatenate([run.pair_keys() for run in runs])) if runs else np.zeros(0, dtype=np.int64)
+        features = np.full((len(keys), len(runs)), default)
+        for j, run in enumerate(runs):
+            features[np.searchsorted(keys, run.pair_keys()), j] = run.scores
+        return cls(vocab, (keys >> 32).astype(np.int32), (keys & 0xFFFFFFFF).astype(np.int32), features,
+                   [path.name for path in paths])
+
+    @classmethod
+    def from_features(cls, path: Path, vocab: RunVocab) -> 'FeatureIndex':
+        """A feature store directory (--store-dir) or a sparse RankLib file with its .features sidecar."""
+        if path.is_dir():
+            store = open_feature_store(path)
+            features, qids, dids, names = store.features, store.qids.tolist(), store.dids.tolist(), store.feature_desc
+        else:
+            data = read_ranklib(path)
+            if data.feature_desc is None:
+                # Dense RankLib lines number their features consecutively, skipping absent prompt classes
+                raise ValueError(f"{path} has no .features sidecar: use a feature store or --sparse RankLib output")
+            features, qids, dids, names = data.features, data.qids, data.dids, data.feature_desc
+        features = features if isinstance(features, np.ndarray) else features.to_dense()
+        return cls(vocab, vocab.qids.encode(qids), vocab.docids.encode(dids), features, names)
+
+    def lookup(self, run: Run, default: float) -> np.ndarray:
+        """Feature rows for the rows of `run`, `default` everywhere for documents without features."""
+        assert run.vocab is self.vocab, "run must be read with the RunVocab of the feature index"
+        keys = run.pair_keys()
+        pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = self.keys[pos] == keys if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        result = np.full((len(run), len(self.feature_names)), default, dtype=np.float64)
+        result[found] = self.features[self.order[pos[found]]]
+        return result
+
+def join_run(run: Run, index: FeatureIndex, default: float = DEFAULT_FEATURE_VALUE) -> JoinedSystem:
+    """The base run's documents with their base score (OrigScore) and their features from `index`."""
+    run = run.dedupe()
+    # Group the rows by query, keeping the base run's order within each query
+    run = run.select(np.argsort(run.qids, kind='stable'))
+    features = np.hstack([run.scores[:, None], index.lookup(run, default)])
+    return JoinedSystem(run, features, [ORIG_SCORE] + index.feature_names)
+
+def join_system(base_run_path: Path, index: FeatureIndex, default: float = DEFAULT_FEATURE_VALUE) -> JoinedSystem:
+    return join_run(read_run(base_run_path, index.vocab), index, default)
+
+def build_index(vocab: RunVocab, feature_run_dir: Optional[Path] = None, features: Optional[Path] = None,
+                default: float = DEFAULT_FEATURE_VALUE) -> FeatureIndex:
+    """The feature index of either the criterion runs in `feature_run_dir` or a `features` store / RankLib file."""
+    if feature_run_dir is not None:
+        return FeatureIndex.from_runs(sorted(feature_run_dir.glob("*.run")), vocab, default)
+    return FeatureIndex.from_features(features, vocab)
+
+class JoinedFeatures:
+    """
+    Joined features of many systems in one `.npz` file (see write_joined): all rows of all
+    systems stacked, system `i` in rows `offsets[i]:offsets[i+1]`.
+    """
+
+    def __init__(self, path: Path):
+        with np.load(path) as data:
+            self.systems: List[str] = data['systems'].tolist()
+            self.offsets = data['offsets']
+            self.qids = data['qids']
+            self.dids = data['dids']
+            self.scores = data['scores']
+            self.features = data['features']
+            self.feature_names: List[str] = data['feature_names'].tolist()
+        self.index = {system: i for i, system in enumerate(self.systems)}
+
+    def system(self, name: str, vocab: Optional[RunVocab] = None) -> JoinedSystem:
+        """The joined rows of one system, ids interned into `vocab` (a new one if None)."""
+        vocab = vocab or RunVocab()
+        i = self.index[name]
+        rows = slice(self.offsets[i], self.offsets[i + 1])
+        n = self.offsets[i + 1] - self.offsets[i]
+        run = Run(vocab, vocab.qids.encode(self.qids[rows].tolist()), vocab.docids.encode(self.dids[rows].tolist()),
+                  self.scores[rows], np.zeros(n, dtype=np.int32))
+        return JoinedSystem(run, self.features[rows], self.feature_names)
+
+def write_joined(path: Path, systems: Iterable[Tuple[str, JoinedSystem]]):
+    """Write joined systems into one uncompressed `.npz` file, read back with JoinedFeatures."""
+    names, offsets, qids, dids, scores, features = [], [0], [], [], [], []
+    feature_names = None
+    for name, joined in systems:
+        if feature_names is not None and joined.feature_names != feature_names:
+            raise ValueError(f"{name} has different features than the systems before it")
+        feature_names = joined.feature_names
+        names.append(name)
+        offsets.append(offsets[-1] + len(joined.run))
+        qids += joined.run.vocab.qids.decode(joined.run.qids)
+        dids += joined.run.vocab.docids.decode(joined.run.docids)
+        scores.append(joined.run.scores)
+        features.append(joined.features)
+    n_features = len(feature_names or [])
+    np.savez(
+        path, systems=np.array(names, dtype=str), offsets=np.array(offsets, dtype=np.int64),
+        qids=np.array(qids, dtype=str), dids=np.array(dids, dtype=str),
+        scores=np.concatenate(scores) if scores else np.zeros(0),
+        features=np.vstack(features) if features else np.zeros((0, n_features)),
+        feature_names=np.array(feature_names or [], dtype=str),
+    )
+
+# Feature index shared by the join tasks of a worker process
+_index = None
+_default = DEFAULT_FEATURE_VALUE
+
+def _init_worker(feature_run_dir: Optional[Path], features: Optional[Path], default: float):
+    global _index, _default
+    _index = build_index(RunVocab(), feature_run_dir, features, default)
+    _default = default
+
+def _join_task(base_run_path: Path) -> Tuple[str, JoinedCodes]:
+    return base_run_path.stem, JoinedCodes.from_joined(join_system(base_run_path, _index, _default))
+
+def join_systems(base_runs: List[Path], feature_run_dir: Optional[Path] = None, features: Optional[Path] = None,
+                 default: float = DEFAULT_FEATURE_VALUE, workers: int = 1) -> Iterator[Tuple[str, JoinedSystem]]:
+    """Yield (system name, joined features) for every base run, in order, joining `workers` runs at a time."""
+    if workers > 1:
+        # Workers send back codes and the labels of each system's ids, interned into one vocabulary here
+        vocab = RunVocab()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(feature_run_dir, features, default)) as pool:
+            for name, codes in pool.map(_join_task, base_runs):
+                yield name, codes.to_joined(vocab)
+    else:
+        _init_worker(feature_run_dir, features, default)
+        for base_run_path in base_runs:
+            yield base_run_path.stem, join_system(base_run_path, _index, _default)
+
+def main():
+    parser = argparse.ArgumentParser(description="Join every base system run with the criterion features on (qid, docid) into one binary file, replacing the filtered run files")
+    parser.add_argument("--base-run-dir", required=True, type=Path, help="Directory with the base system *.run files")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--feature-run-dir", type=Path, help="Directory with the criterion *.run files (from build_feature_vectors.py --criteria-run-dir)")
+    source.add_argument("--features", type=Path, help="Feature store directory (--store-dir) or sparse RankLib file from build_feature_vectors.py")
+    parser.add_argument("--output", "-o", required=True, type=Path, help="Output .npz file")
+    parser.add_argument("--default-any-feature-value", type=float, default=DEFAULT_FEATURE_VALUE, help=f"Value of missing features (default: {DEFAULT_FEATURE_VALUE})")
+    parser.add_argument("--workers", type=int, default=1, help="Number of base runs joined in parallel")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    base_runs = sorted(args.base_run_dir.glob("*.run"))
+    joined = join_systems(base_runs, args.feature_run_dir, args.features, args.default_any_feature_value, args.workers)
+    write_joined(args.output, joined)
+    logging.info(f"Joined {len(base_runs)} systems into {args.output}")
+
+if __name__ == "__main__":
+    main()
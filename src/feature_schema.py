@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from typing import Callable, List, Tuple, Dict, Set, NamedTuple, Optional, Sequence
+import numpy as np
+
+# Type definitions
+QuestionId = str
+Rating = Tuple[QuestionId, int]
+
+SINGLE_ONE_HOT_MODES = {'all_rubric_concat', ''}
+
+# Criteria rated by the FourPrompts prompt class (mode 'multi_criteria'), one run file each
+CRITERIA = ['Exactness', 'Topicality', 'Coverage', 'Contextual Fit']
+
+# Default number of rating patterns whose feature columns FeatureSchema keeps (see FeatureMemo)
+MEMO_MAX_ENTRIES = 16384
+LIST_ONE_HOT_MODES = {'all_rubric_concat', '', 'multi_criteria'}
+
+def prompt_classes_for_mode(mode: str = '') -> Dict[str, Set[int]]:
+    """
+    Prompt classes (and their valid ratings) that contribute features in a mode.
+
+    Args:
+        mode: Feature mode ('nuggets', 'questions', 'multi_criteria', 'all_rubric_concat', or '' for default).
+    """
+    prompt_classes = {}
+    if mode == 'nuggets':
+        prompt_classes['NuggetSelfRatedPrompt'] = {0, 1, 2, 3, 4, 5}
+    elif mode == 'questions':
+        prompt_classes['QuestionSelfRatedUnanswerablePromptWithChoices'] = {0, 1, 2, 3, 4, 5}
+    elif mode == 'multi_criteria':
+        prompt_classes['FourPrompts'] = {0, 1, 2, 3}
+    else:  # mode == 'all_rubric_concat' or default
+        prompt_classes['NuggetSelfRatedPrompt'] = {0, 1, 2, 3, 4, 5}
+        prompt_classes['QuestionSelfRatedUnanswerablePromptWithChoices'] = {0, 1, 2, 3, 4, 5}
+        prompt_classes |= {
+            'FagB': {0, 1},
+            'FagB_few': {0, 1},
+            'HELM': {0, 1},
+            'Sun': {0, 1},
+            'Sun_few': {0, 1},
+            'Thomas': {0, 1, 2},
+        }
+    return prompt_classes
+
+# Prompt classes of all modes
+ALL_PROMPT_CLASSES = sorted(set(prompt_classes_for_mode('')) | set(prompt_classes_for_mode('multi_criteria')))
+
+def expected_ratings(pclass: str) -> int:
+    """Number of rating slots a prompt class contributes per sort order."""
+    return 10 if pclass in {'NuggetSelfRatedPrompt', 'QuestionSelfRatedUnanswerablePromptWithChoices'} else 4 if pclass == 'FourPrompts' else 1
+
+class Segment(NamedTuple):
+    """A run of columns holding one sort order of a prompt class' ratings."""
+    sort: str       # 'mean_rating', 'informativeness' or 'rating'
+    one_hot: bool
+    offset: int
+
+class ClassLayout(NamedTuple):
+    """Column layout of one prompt class inside the feature vector."""
+    pclass: str
+    valid_range: Set[int]
+    start: int
+    stop: int
+    single: bool          # one integer rating (+ one-hot) instead of sorted rating lists
+    n_ratings: int        # expected number of ratings per sort order
+    n_values: int         # max(valid_range) + 1, the width of a one-hot encoding
+    segments: Tuple[Segment, ...]
+    one_hot_offset: int   # single classes only, -1 if absent
+    count_offset: int     # list classes only
+
+class FeatureMemo:
+    """
+    Bounded LRU map from (prompt class, ratings) to the precomputed columns of that prompt class.
+
+    Ratings are small discrete values, so the same (question id, rating) lists recur across
+    many documents of a run; their feature columns only depend on the rating statistics of
+    the run, which are fixed while the memo is in use.
+    """
+
+    def __init__(self, max_entries: int = MEMO_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[tuple, np.ndarray]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[np.ndarray]:
+        block = self.entries.get(key)
+        if block is not None:
+            self.entries.move_to_end(key)
+        return block
+
+    def put(self, key: tuple, block: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        block.setflags(write=False)
+        self.entries[key] = block
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def record(self, hits: int, misses: int):
+        """Add lookups counted elsewhere, e.g. by the copies of the schema in worker processes."""
+        self.hits += hits
+        self.misses += misses
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class FeatureSchema:
+    """
+    Fixed feature layout for a set of prompt classes, a mode and the one-hot setting.
+
+    Column offsets of every prompt class are computed once, so the feature vectors of
+    all documents of a query are filled into one preallocated `(n_docs, n_features)`
+    matrix with array writes. A prompt class without ratings for a document leaves its
+    columns at zero and is marked as absent in the `present` mask returned alongside.
+    The columns of list prompt classes are memoized per rating pattern (see FeatureMemo).
+    """
+
+    def __init__(self, prompt_classes: Dict[str, Set[int]], mode: str = '', use_one_hot: bool = True,
+                 memo_size: int = MEMO_MAX_ENTRIES):
+        self.prompt_classes = prompt_classes
+        self.mode = mode
+        self.use_one_hot = use_one_hot
+        self.feature_desc: List[str] = []
+        self.layouts: List[ClassLayout] = []
+
+        for pclass, valid_range in prompt_classes.items():
+            start = len(self.feature_desc)
+            n_values = max(valid_range) + 1
+            single = len(valid_range) <= 3 and pclass != 'FourPrompts'
+            n_ratings = expected_ratings(pclass)
+            segments = []
+            one_hot_offset = -1
+            count_offset = -1
+            if single:
+                segments.append(Segment('rating', False, self._add([f"{pclass}_integer_rating"])))
+                if mode in SINGLE_ONE_HOT_MODES and use_one_hot:
+                    one_hot_offset = self._add([f"{pclass}_one_hot_{j}" for j in range(n_values)])
+            else:
+                one_hot = (mode in LIST_ONE_HOT_MODES or pclass == 'FourPrompts') and use_one_hot
+                sorts = [('mean_rating', False), ('mean_rating', True), ('informativeness', True),
+                         ('rating', False), ('rating', True)]
+                for sort, is_one_hot in sorts:
+                    if is_one_hot and not one_hot:
+                        continue
+                    if sort == 'informativeness' and pclass == 'FourPrompts':
+                        continue
+                    if is_one_hot:
+                        desc = [f"{pclass}_one_hot_{sort}_{i}_{j}" for i in range(n_ratings) for j in range(n_values)]
+                    else:
+                        desc = [f"{pclass}_int_{sort}_{i}" for i in range(n_ratings)]
+                    segments.append(Segment(sort, is_one_hot, self._add(desc)))
+                count_offset = self._add([f"{pclass}_count_geq_{n}" for n in range(max(valid_range))])
+            self.layouts.append(ClassLayout(
+                pclass, valid_range, start, len(self.feature_desc), single, n_ratings, n_values,
+                tuple(segments), one_hot_offset, count_offset
+            ))
+
+        self.n_features = len(self.feature_desc)
+        has_one_hot = any(l.one_hot_offset >= 0 or any(s.one_hot for s in l.segments) for l in self.layouts)
+        # One-hot encodings make the RankLib values floats ("1.0"), otherwise they are integers
+        self.dtype = np.float64 if has_one_hot else np.int64
+        self.class_widths = np.array([l.stop - l.start for l in self.layouts])
+        self.memo = FeatureMemo(memo_size)
+        # Rating statistics the memoized columns were computed with
+        self._memo_stats = None
+
+    def _add(self, desc: List[str]) -> int:
+        offset = len(self.feature_desc)
+        self.feature_desc += desc
+        return offset
+
+    def build_matrix(
+        self,
+        docs_ratings: Sequence[Dict[str, List[Rating]]],
+        mean_rating: Dict[QuestionId, float],
+        hist: Dict[QuestionId, Dict[int, int]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Fill the feature vectors of all documents of one query.
+
+        Args:
+            docs_ratings: Per document, the (question_id, self_rating) pairs of each prompt class.
+            mean_rating: Mean rating per question/criterion, used to order ratings.
+            hist: Rating histogram per question/criterion, used for the informativeness order.
+
+        Returns:
+            The `(n_docs, n_features)` feature matrix and the `(n_docs, n_classes)` mask of
+            prompt classes that had ratings for the document.
+        """
+        n_docs = len(docs_ratings)
+        matrix = np.zeros((n_docs, self.n_features), dtype=self.dtype)
+        present = np.zeros((n_docs, len(self.layouts)), dtype=bool)
+        if self._memo_stats is None or self._memo_stats[0] is not mean_rating or self._memo_stats[1] is not hist:
+            self.memo.clear()
+            self._memo_stats = (mean_rating, hist)
+        sort_keys = {
+            'mean_rating': lambda q: mean_rating.get(q[0], 0),
+            'informativeness': lambda q: hist.get(q[0], {}).get(4, 0) + hist.get(q[0], {}).get(5, 0),
+            'rating': lambda q: q[1],
+        }
+
+        for c, layout in enumerate(self.layouts):
+            rows = [i for i, doc in enumerate(docs_ratings) if doc.get(layout.pclass)]
+            if not rows:
+                continue
+            present[rows, c] = True
+            class_ratings = [docs_ratings[i][layout.pclass] for i in rows]
+
+            if layout.single:
+                valid_range = layout.valid_range
+                values = np.array([ratings[0][1] if ratings[0][1] in valid_range else 0 for ratings in class_ratings])
+                matrix[rows, layout.segments[0].offset] = values
+                if layout.one_hot_offset >= 0:
+                    matrix[rows, layout.one_hot_offset + values] = 1
+                continue
+
+            keys = [(layout.pclass, tuple(ratings)) for ratings in class_ratings]
+            blocks = [self.memo.get(key) for key in keys]
+            missed = list(dict.fromkeys(key for key, block in zip(keys, blocks) if block is None))
+            self.memo.record(len(keys) - len(missed), len(missed))
+            if missed:
+                computed = dict(zip(missed, self._list_class_block(layout, [key[1] for key in missed], sort_keys)))
+                for key, block in computed.items():
+                    self.memo.put(key, block)
+                blocks = [computed[key] if block is None else block for key, block in zip(keys, blocks)]
+            matrix[rows, layout.start:layout.stop] = np.stack(blocks)
+
+        return matrix, present
+
+    def _list_class_block(self, layout: ClassLayout, class_ratings: Sequence[Sequence[Rating]],
+                          sort_keys: Dict[str, Callable]) -> np.ndarray:
+        """The `layout.start:layout.stop` columns of a list prompt class, one row per ratings list."""
+        block = np.zeros((len(class_ratings), layout.stop - layout.start), dtype=self.dtype)
+        rows = np.arange(len(class_ratings))
+        valid_range = layout.valid_range
+
+        def clamp(x: int) -> int:
+            return 0 if x not in valid_range else x
+
+        n = layout.n_ratings
+        slots = np.arange(n) * layout.n_values
+        padded_by_sort = {}
+        for segment in layout.segments:
+            offset = segment.offset - layout.start
+            padded = padded_by_sort.get(segment.sort)
+            if padded is None:
+                key = sort_keys[segment.sort]
+                padded = np.array([
+                    ([clamp(rating) for _, rating in sorted(ratings, key=key, reverse=True)][:n] +
+                     [0] * (n - len(ratings)))
+                    for ratings in class_ratings
+                ], dtype=np.int64)
+                padded_by_sort[segment.sort] = padded
+            if segment.one_hot:
+                block[rows[:, None], offset + slots + padded] = 1
+            else:
+                block[:, offset:offset + n] = padded
+
+        counts = np.array([
+            [sum(1 for _, r in ratings if r >= m) for m in range(layout.n_values - 1)]
+            for ratings in class_ratings
+        ], dtype=np.int64)
+        count_offset = layout.count_offset - layout.start
+        block[:, count_offset:count_offset + layout.n_values - 1] = counts
+        return block
+
+    def present_columns(self, present_row: np.ndarray) -> np.ndarray:
+        """Boolean column mask selecting the blocks of the prompt classes present for a document."""
+        return np.repeat(present_row, self.class_widths)
+
+    def present_desc(self, present_row: np.ndarray) -> List[str]:
+        """Feature descriptions of the columns selected by present_columns."""
+        return [d for d, keep in zip(self.feature_desc, self.present_columns(present_row)) if keep]
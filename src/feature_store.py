@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Union, BinaryIO, Dict
+import numpy as np
+import logging
+import json
+import os
+import shutil
+import tempfile
+
+from ranklib_io import CsrMatrix
+
+# Layout of a feature store directory:
+#   meta.json         format ('dense' or 'sparse'), dtype, n_docs and feature_desc (column names)
+#   features.npy      (n_docs, n_features) matrix                      [dense]
+#   indptr.npy, indices.npy, data.npy   CSR parts of that matrix       [sparse]
+#   labels.npy, qids.npy, dids.npy      per-row relevance label, query id and doc id
+META_FILE = 'meta.json'
+MATRIX_PARTS = {'dense': ['features'], 'sparse': ['indptr', 'indices', 'data']}
+ROW_PARTS = ['labels', 'qids', 'dids']
+
+class FeatureStore(NamedTuple):
+    """A feature set opened from a feature store directory."""
+    features: Union[np.ndarray, CsrMatrix]
+    labels: np.ndarray
+    qids: np.ndarray
+    dids: np.ndarray
+    feature_desc: List[str]
+
+class FeatureStoreWriter:
+    """
+    Write feature vectors query by query into a directory of `.npy` files.
+
+    Rows are appended to raw files while queries stream in and are turned into `.npy`
+    arrays on close(), so the number of rows does not need to be known up front and
+    the matrix is never held in memory as a whole.
+
+    Everything is written to a temporary subdirectory and moved into `directory` by
+    close(), meta.json last, replacing a store written before (in either format). If
+    writing fails, abort() (or leaving a `with` block by an exception) removes the
+    temporary files and leaves the previous store as it was.
+    """
+
+    def __init__(self, directory: Path, feature_desc: List[str], dtype, sparse: bool = False):
+        self.directory = directory
+        self.feature_desc = feature_desc
+        self.dtype = np.dtype(dtype)
+        self.sparse = sparse
+        self.n_docs = 0
+        self.n_values = 0
+        self.labels: List[int] = []
+        self.qids: List[str] = []
+        self.dids: List[str] = []
+        self.indptr: List[int] = [0]
+        self.paths: List[Path] = []  # Files of the store, once closed
+        directory.mkdir(parents=True, exist_ok=True)
+        self.work_dir = Path(tempfile.mkdtemp(dir=directory, prefix='.writing-'))
+        parts = ['indices', 'data'] if sparse else ['features']
+        self.raw: Dict[str, BinaryIO] = {part: (self.work_dir / f"{part}.bin").open('wb') for part in parts}
+
+    def add(self, qid: str, dids: List[str], labels: List[int], features: Union[np.ndarray, CsrMatrix]):
+        """Append the rows of one query; `features` is CSR for a sparse store, dense otherwise."""
+        self.qids += [qid] * len(dids)
+        self.dids += dids
+        self.labels += labels
+        if self.sparse:
+            self.raw['indices'].write(features.indices.astype(np.int32).tobytes())
+            self.raw['data'].write(features.data.astype(self.dtype).tobytes())
+            self.indptr += (features.indptr[1:] + self.n_values).tolist()
+            self.n_values += len(features.indices)
+        else:
+            self.raw['features'].write(np.ascontiguousarray(features, dtype=self.dtype).tobytes())
+        self.n_docs += len(dids)
+
+    def _finish_raw(self, part: str, dtype, shape: tuple):
+        self.raw[part].close()
+        raw_path = self.work_dir / f"{part}.bin"
+        out = np.lib.format.open_memmap(self.work_dir / f"{part}.npy", mode='w+', dtype=dtype, shape=shape)
+        if out.size:
+            out[...] = np.memmap(raw_path, dtype=dtype, mode='r', shape=shape)
+        out.flush()
+        del out
+        raw_path.unlink()
+
+    def close(self):
+        if self.sparse:
+            self._finish_raw('indices', np.int32, (self.n_values,))
+            self._finish_raw('data', self.dtype, (self.n_values,))
+            np.save(self.work_dir / 'indptr.npy', np.array(self.indptr, dtype=np.int64))
+        else:
+            self._finish_raw('features', self.dtype, (self.n_docs, len(self.feature_desc)))
+        np.save(self.work_dir / 'labels.npy', np.array(self.labels, dtype=np.int64))
+        np.save(self.work_dir / 'qids.npy', np.array(self.qids, dtype=str))
+        np.save(self.work_dir / 'dids.npy', np.array(self.dids, dtype=str))
+        store_format = 'sparse' if self.sparse else 'dense'
+        with (self.work_dir / META_FILE).open('w') as f:
+            json.dump({
+                'format': store_format,
+                'dtype': self.dtype.str,
+                'n_docs': self.n_docs,
+                'feature_desc': self.feature_desc,
+            }, f, indent=1)
+
+        # Without meta.json the directory is not a store until every array is in place
+        (self.directory / META_FILE).unlink(missing_ok=True)
+        names = [f"{part}.npy" for part in MATRIX_PARTS[store_format] + ROW_PARTS]
+        for name in names + [META_FILE]:
+            os.replace(self.work_dir / name, self.directory / name)
+        # Matrix parts of a store written before in the other format
+        stale = {part for parts in MATRIX_PARTS.values() for part in parts} - set(MATRIX_PARTS[store_format])
+        for part in sorted(stale):
+            (self.directory / f"{part}.npy").unlink(missing_ok=True)
+        self.work_dir.rmdir()
+        self.paths = [self.directory / name for name in names + [META_FILE]]
+        logging.info(f"Wrote {self.n_docs} feature vectors to {self.directory}")
+
+    def abort(self):
+        """Discard the rows written so far; does nothing after close()."""
+        for raw in self.raw.values():
+            raw.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def open_feature_store(directory: Path, mmap_mode: Optional[str] = 'r') -> FeatureStore:
+    """
+    Open a feature store written by FeatureStoreWriter.
+
+    With the default `mmap_mode='r'` the arrays are memory-mapped, so even a multi-GB
+    feature set opens instantly and only the pages that are touched are read.
+
+    Args:
+        directory: Feature store directory.
+        mmap_mode: Passed to np.load; None loads the arrays into memory.
+    """
+    with (directory / META_FILE).open('r') as f:
+        meta = json.load(f)
+
+    def load(name: str) -> np.ndarray:
+        return np.load(directory / f"{name}.npy", mmap_mode=mmap_mode)
+
+    if meta['format'] == 'sparse':
+        features = CsrMatrix(load('indptr'), load('indices'), load('data'), (meta['n_docs'], len(meta['feature_desc'])))
+    else:
+        features = load('features')
+    return FeatureStore(features, load('labels'), load('qids'), load('dids'), meta['feature_desc'])
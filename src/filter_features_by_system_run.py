@@ -1,25 +1,23 @@
 import os
 import argparse
-from collections import defaultdict
 
-def read_run(file_path):
-    run = defaultdict(dict)
-    with open(file_path) as f:
-        for line in f:
-            qid, _, docid, rank, score, _ = line.strip().split()
-            run[qid][docid] = float(score)
-    return run
+import run_io
+from run_io import RunVocab, write_run
 
-def get_all_qid_doc_pairs(run):
-    return {(qid, docid) for qid in run for docid in run[qid]}
+def read_run(file_path, vocab=None, intern=True):
+    """Columnar run (see run_io.Run); a (qid, docid) pair listed twice keeps its last score."""
+    return run_io.read_run(file_path, vocab, intern=intern).dedupe()
 
-def write_filtered_run(run, allowed_qid_doc_pairs, output_path):
-    with open(output_path, 'w') as out:
-        for qid in sorted(run.keys()):
-            for docid in sorted(run[qid].keys()):
-                if (qid, docid) in allowed_qid_doc_pairs:
-                    score = run[qid][docid]
-                    out.write(f"{qid} Q0 {docid} 0 {score} filtered\n")  # rank=0, will be ignored by ranklips
+def write_filtered_run(run, base_run, output_path, presorted=False):
+    """
+    Write the rows of `run` whose (qid, docid) pair occurs in `base_run`, ordered by qid and docid.
+    Both runs must have been read with the same RunVocab. With `presorted`, `run` is already
+    ordered by Run.sorted_by_ids, which selecting rows keeps.
+    """
+    run = run.select(run.isin(base_run))
+    if not presorted:
+        run = run.sorted_by_ids()
+    write_run(output_path, run, rank=0, tag='filtered')  # rank=0, will be ignored by ranklips
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -29,12 +27,12 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    base_run = read_run(args.base_run)
-    allowed_pairs = get_all_qid_doc_pairs(base_run)
+    vocab = RunVocab()
+    base_run = read_run(args.base_run, vocab)
 
     os.makedirs(args.output_dir, exist_ok=True)
     for feat_path in args.feature_runs:
-        run = read_run(feat_path)
+        run = read_run(feat_path, vocab)
         out_path = os.path.join(args.output_dir, os.path.basename(feat_path))
-        write_filtered_run(run, allowed_pairs, out_path)
+        write_filtered_run(run, base_run, out_path)
         print(f"Wrote filtered feature file to {out_path}")
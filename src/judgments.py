@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import List, Tuple, Dict, Iterator, NamedTuple, Optional
+from collections import Counter
+import tempfile
+import functools
+import hashlib
+import json
+import logging
+import pickle
+import queue
+import gzip
+import os
+import threading
+
+# Assume exam_pp.data_model provides these
+from exam_pp.data_model import QueryWithFullParagraphList, GradeFilter, parseQueryWithFullParagraphList
+
+from feature_schema import ALL_PROMPT_CLASSES
+
+# Optional accelerators of the lean reader (iter_lean_query_grades)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+# Type definitions
+QueryId = str
+DocId = str
+QuestionId = str
+PromptClass = str
+# Count of every self-rating value per question/criterion id over a whole judgements file
+RatingHistogram = Dict[QuestionId, Dict[int, int]]
+
+# Prompt class of grades that predate prompt_info tracking (no prompt_info at all)
+DEFAULT_PROMPT_CLASS = 'QuestionPromptWithChoices'
+# Ratings of grades whose prompt_info names no prompt class; GradeFilter matches these for
+# every prompt class, so they are also filed under every prompt class (see add_ratings)
+ANY_PROMPT_CLASS = '*'
+
+# On-disk cache of indexed judgements, keyed by the content hash of the judgements file
+DEFAULT_CACHE_DIR = Path(os.environ.get('LTR_RUBRIC_CACHE', Path.home() / '.cache' / 'ltr_rubric')) / 'judgements'
+DEFAULT_CACHE_MAX_BYTES = 8 * 1024 ** 3
+CACHE_FORMAT_VERSION = 2
+
+SELF_GRADED = GradeFilter.noFilter()
+SELF_GRADED.is_self_rated = True
+
+# Decompressed bytes handed from the gzip thread to the lean reader at once
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+# Question id exam_pp gives the rating of a direct grading prompt (Grades.as_exam_grades)
+DIRECT_GRADE_ID = 'direct'
+
+class ParagraphGrades(NamedTuple):
+    """Self-ratings of one paragraph, indexed by prompt class (see add_ratings)."""
+    paragraph_id: DocId
+    grades: Dict[PromptClass, List[Tuple[QuestionId, int]]]
+
+class QueryGrades(NamedTuple):
+    """Self-ratings of all paragraphs judged for one query."""
+    query_id: QueryId
+    paragraphs: List[ParagraphGrades]
+
+def grade_prompt_class(grade) -> Optional[PromptClass]:
+    """Prompt class of an ExamGrades object, as matched by GradeFilter.prompt_class (None: any)."""
+    if grade.prompt_info is None:
+        return DEFAULT_PROMPT_CLASS
+    return grade.prompt_info.get('prompt_class')
+
+def add_ratings(grades: Dict[PromptClass, List[Tuple[QuestionId, int]]], pclass: Optional[PromptClass],
+                ratings: List[Tuple[QuestionId, int]]):
+    """
+    File the ratings of one grade under its prompt class (updated in place).
+
+    Ratings of a grade without prompt class (None) are filed under ANY_PROMPT_CLASS and
+    every prompt class, so each prompt class lists the ratings GradeFilter(prompt_class)
+    selects, in grade order.
+    """
+    if pclass is None:
+        for key in ALL_PROMPT_CLASSES:
+            if key not in grades:
+                grades[key] = list(grades.get(ANY_PROMPT_CLASS, []))
+        grades.setdefault(ANY_PROMPT_CLASS, [])
+        for key in grades:
+            grades[key] += ratings
+    else:
+        if pclass not in grades:
+            grades[pclass] = list(grades.get(ANY_PROMPT_CLASS, []))
+        grades[pclass] += ratings
+
+def index_paragraph(para) -> ParagraphGrades:
+    """
+    Index the self-ratings of a paragraph by prompt class with a single scan over its grades.
+
+    Args:
+        para: FullParagraphData object.
+    """
+    grades = {}
+    for grade in para.retrieve_exam_grade_all(SELF_GRADED):
+        add_ratings(grades, grade_prompt_class(grade), [
+            (QuestionId(s.get_id()), s.self_rating) for s in grade.self_ratings or []
+        ])
+    return ParagraphGrades(DocId(para.paragraph_id), grades)
+
+def index_query(q: QueryWithFullParagraphList) -> QueryGrades:
+    """
+    Index the self-ratings of every paragraph of a query, see index_paragraph.
+
+    The result no longer references the exam_pp objects (passage text, explanations, ...),
+    which can be garbage collected right away.
+    """
+    return QueryGrades(QueryId(q.queryId), [index_paragraph(para) for para in q.paragraphs])
+
+def iter_judgements(path: Path) -> Iterator[QueryWithFullParagraphList]:
+    """
+    Stream queries from a judgements JSONL.gz file, one line (query) at a time.
+
+    Unlike parseQueryWithFullParagraphs, only the current query is held in memory.
+    A truncated gzip file is handled like exam_pp does: a warning is logged and
+    the queries read so far are kept.
+
+    Args:
+        path: Path to the exampp judgements file (JSONL.gz).
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                yield parseQueryWithFullParagraphList(line)
+    except EOFError as e:
+        logging.warning(f"Truncated judgements file {path}, using queries read so far: {e}")
+
+def iter_query_grades(path: Path) -> Iterator[QueryGrades]:
+    """Stream the indexed self-ratings of a judgements file, one query at a time."""
+    for q in iter_judgements(path):
+        yield index_query(q)
+
+def _json_loads(line: bytes):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+def _self_rating_id(rating: dict) -> QuestionId:
+    """SelfRating.get_id on the decoded JSON of a self-rating."""
+    question_id = rating.get('question_id')
+    if question_id is None:
+        question_id = rating.get('nugget_id')
+    if question_id is None:
+        raise ValueError(f"Self-rating without question_id or nugget_id: {rating}")
+    return QuestionId(question_id)
+
+def _json_prompt_class(grade: dict) -> Optional[PromptClass]:
+    prompt_info = grade.get('prompt_info')
+    if prompt_info is None:
+        return DEFAULT_PROMPT_CLASS
+    return prompt_info.get('prompt_class')
+
+def index_paragraph_json(para: dict) -> ParagraphGrades:
+    """
+    index_paragraph on the decoded JSON of a paragraph, without building the exam_pp model.
+
+    Selects the same grades as `retrieve_exam_grade_all(SELF_GRADED)`: self-rated
+    `exam_grades`, followed by self-rated direct `grades` (one rating each, with the
+    question id exam_pp assigns them).
+    """
+    grades = {}
+    for grade in para.get('exam_grades') or []:
+        if grade.get('self_ratings') is not None:
+            add_ratings(grades, _json_prompt_class(grade), [
+                (_self_rating_id(s), int(s['self_rating'])) for s in grade['self_ratings']
+            ])
+    for grade in para.get('grades') or []:
+        if grade.get('self_ratings') is not None:
+            add_ratings(grades, _json_prompt_class(grade), [(DIRECT_GRADE_ID, int(grade['self_ratings']))])
+    return ParagraphGrades(DocId(para['paragraph_id']), grades)
+
+def _read_blocks(file) -> Iterator[bytes]:
+    """
+    Blocks of about READ_BLOCK_SIZE bytes from a decompressing file. On a truncated file the
+    data decompressed before the error is yielded before EOFError is raised.
+    """
+    pending = bytearray()
+    try:
+        while chunk := file.read1(READ_BLOCK_SIZE):
+            pending += chunk
+            if len(pending) >= READ_BLOCK_SIZE:
+                yield bytes(pending)
+                pending.clear()
+    except EOFError:
+        if pending:
+            yield bytes(pending)
+        raise
+    if pending:
+        yield bytes(pending)
+
+def _produce_blocks(path: Path, blocks: queue.Queue, stop: threading.Event):
+    """Decompress `path` into `blocks`; ends with None, or with the exception that stopped it."""
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        with gzip.open(path, 'rb') as file:
+            for block in _read_blocks(file):
+                if not put(block):
+                    return
+        put(None)
+    except Exception as e:
+        put(e)
+
+def _iter_gzip_blocks(path: Path, threads: int) -> Iterator[bytes]:
+    """
+    Decompressed blocks of a gzip file, decompressed in other threads than the caller's.
+
+    Uses isal's multi-threaded reader when it is installed, otherwise one producer thread
+    (zlib releases the GIL, so decompression overlaps with JSON decoding either way).
+    """
+    if igzip_threaded is not None:
+        with igzip_threaded.open(path, 'rb', threads=threads) as file:
+            yield from _read_blocks(file)
+        return
+
+    blocks = queue.Queue(maxsize=4)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce_blocks, args=(path, blocks, stop), daemon=True)
+    producer.start()
+    try:
+        while (block := blocks.get()) is not None:
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        # Also reached when the caller stops reading early
+        stop.set()
+        producer.join()
+
+def lean_query_grades(line: bytes) -> QueryGrades:
+    """The indexed self-ratings of one line of a judgements file, see index_paragraph_json."""
+    query_id, paragraphs = _json_loads(line)
+    return QueryGrades(QueryId(query_id), [index_paragraph_json(para) for para in paragraphs])
+
+def parse_query_grades(line: bytes, lean: bool = False) -> QueryGrades:
+    """The indexed self-ratings of one line of a judgements file, with exam_pp unless `lean`."""
+    if lean:
+        return lean_query_grades(line)
+    return index_query(parseQueryWithFullParagraphList(line.decode('utf-8')))
+
+def iter_lean_query_grades(path: Path, threads: int = 2) -> Iterator[QueryGrades]:
+    """
+    Stream the indexed self-ratings of a judgements file like iter_query_grades, but
+    without exam_pp: each line is decoded with orjson (if installed) and only query id,
+    paragraph ids, prompt classes and self-ratings are picked from it, see
+    index_paragraph_json. Decompression runs in background threads (see _iter_gzip_blocks).
+    A truncated gzip file is handled like iter_judgements.
+
+    Args:
+        path: Path to the exampp judgements file (JSONL.gz).
+        threads: Decompression threads, if isal is installed.
+    """
+    rest = b''
+    try:
+        for block in _iter_gzip_blocks(path, threads):
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield lean_query_grades(line)
+        if rest.strip():
+            yield lean_query_grades(rest)
+    except EOFError as e:
+        logging.warning(f"Truncated judgements file {path}, using queries read so far: {e}")
+
+def add_to_histogram(hist: RatingHistogram, q: QueryGrades):
+    """Count the self-ratings of one query into `hist` (updated in place), each grade once."""
+    for para in q.paragraphs:
+        unclassified = para.grades.get(ANY_PROMPT_CLASS)
+        for pclass, ratings in para.grades.items():
+            if unclassified and pclass != ANY_PROMPT_CLASS:
+                # Every prompt class also lists the ratings of ANY_PROMPT_CLASS (see add_ratings)
+                ratings = (Counter(ratings) - Counter(unclassified)).elements()
+            for question_id, rating in ratings:
+                counts = hist.setdefault(question_id, {})
+                counts[int(rating)] = counts.get(int(rating), 0) + 1
+
+def file_digest(path: Path) -> str:
+    """Content hash (BLAKE2b) of a file, read in 1 MiB blocks; remembered while the file is unchanged."""
+    stat = path.stat()
+    return _file_digest(path.resolve(), stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=16)
+def _file_digest(path: Path, size: int, mtime_ns: int) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with path.open('rb') as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _cache_entry(cache_dir: Path, key: str) -> Path:
+    return cache_dir / f"{key}.v{CACHE_FORMAT_VERSION}.pkl"
+
+def _stats_entry(entry: Path) -> Path:
+    """Rating statistics stored next to a cache entry."""
+    return entry.with_name(entry.name[:-len('.pkl')] + '.stats.json')
+
+def stats_sidecar_path(path: Path) -> Path:
+    """Precomputed rating statistics shipped next to a judgements file."""
+    return path.with_name(path.name + '.stats.json')
+
+def write_rating_stats(stats_path: Path, digest: str, hist: RatingHistogram):
+    tmp_path = stats_path.with_name(stats_path.name + '.tmp')
+    with tmp_path.open('w') as f:
+        json.dump({'judgements_digest': digest, 'histogram': hist}, f)
+    os.replace(tmp_path, stats_path)
+
+def _read_stats_file(stats_path: Path, digest: str) -> Optional[RatingHistogram]:
+    try:
+        with stats_path.open('r') as f:
+            stats = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable rating statistics {stats_path}: {e}")
+        return None
+    if stats.get('judgements_digest') != digest:
+        logging.warning(f"Ignoring rating statistics {stats_path}: computed for a different judgements file")
+        return None
+    # JSON object keys are strings
+    return {question_id: {int(r): n for r, n in counts.items()} for question_id, counts in stats['histogram'].items()}
+
+def read_rating_stats(path: Path, cache_dir: Optional[Path] = DEFAULT_CACHE_DIR) -> Optional[RatingHistogram]:
+    """
+    Rating histogram of a judgements file without reading it: from the statistics sidecar
+    next to the file (stats_sidecar_path) or the statistics gathered when the file was
+    cached (see iter_cached_query_grades). None if neither exists for the current content.
+    """
+    digest = file_digest(path)
+    hist = _read_stats_file(stats_sidecar_path(path), digest)
+    if hist is None and cache_dir is not None:
+        hist = _read_stats_file(_stats_entry(_cache_entry(cache_dir, digest)), digest)
+    return hist
+
+def save_rating_stats(path: Path, hist: RatingHistogram, cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+                      sidecar: bool = False):
+    """Store the rating histogram of a judgements file in the cache, and next to the file if `sidecar`."""
+    digest = file_digest(path)
+    if sidecar:
+        write_rating_stats(stats_sidecar_path(path), digest, hist)
+        logging.info(f"Wrote rating statistics to {stats_sidecar_path(path)}")
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        write_rating_stats(_stats_entry(_cache_entry(cache_dir, digest)), digest, hist)
+
+def evict_cache(cache_dir: Path, max_bytes: int, keep: Optional[Path] = None):
+    """
+    Delete cache entries of other format versions, then the least recently used
+    entries until the cache fits into `max_bytes`. `keep` is never evicted.
+    """
+    entries = []
+    for entry in cache_dir.glob('*.pkl'):
+        if not entry.name.endswith(f".v{CACHE_FORMAT_VERSION}.pkl"):
+            logging.info(f"Evicting stale judgements cache entry {entry}")
+            entry.unlink(missing_ok=True)
+            _stats_entry(entry).unlink(missing_ok=True)
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        logging.info(f"Evicting judgements cache entry {entry} ({size} bytes)")
+        entry.unlink(missing_ok=True)
+        _stats_entry(entry).unlink(missing_ok=True)
+        total -= size
+
+def _load_cache_entry(entry: Path) -> Iterator[QueryGrades]:
+    with entry.open('rb') as f:
+        while True:
+            try:
+                query_id, paragraphs = pickle.load(f)
+            except EOFError:
+                return
+            yield QueryGrades(query_id, [ParagraphGrades(*para) for para in paragraphs])
+
+def iter_cached_query_grades(
+    path: Path,
+    cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+    max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    lean: bool = False
+) -> Iterator[QueryGrades]:
+    """
+    Stream the indexed self-ratings of a judgements file through an on-disk cache.
+
+    The cache is keyed by the content hash of the judgements file and stores only query
+    id, paragraph id, prompt class, question id and self-rating, one pickled query after
+    the other. On a hit, gzip decompression, JSON decoding and exam_pp model
+    construction are skipped. On a miss, the entry is written while the queries are
+    yielded and only committed once the file was read to the end; an interrupted or
+    partial read leaves no entry behind. The rating histogram (see read_rating_stats) is
+    gathered while the entry is written and committed with it. Least recently used
+    entries are evicted to keep the cache under `max_bytes`.
+
+    Args:
+        path: Path to the exampp judgements file (JSONL.gz).
+        cache_dir: Cache directory, or None to bypass the cache.
+        max_bytes: Size limit of the cache directory.
+        lean: Parse the judgements with iter_lean_query_grades instead of exam_pp.
+    """
+    read = iter_lean_query_grades if lean else iter_query_grades
+    if cache_dir is None:
+        yield from read(path)
+        return
+
+    digest = file_digest(path)
+    entry = _cache_entry(cache_dir, digest)
+    if entry.exists():
+        logging.info(f"Reading cached judgements for {path} from {entry}")
+        os.utime(entry)
+        yield from _load_cache_entry(entry)
+        return
+
+    logging.info(f"Caching judgements of {path} in {entry}")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(dir=cache_dir, prefix=entry.name, suffix='.tmp', delete=False)
+    complete = False
+    hist: RatingHistogram = {}
+    try:
+        with tmp:
+            for q in read(path):
+                pickle.dump((q.query_id, [tuple(para) for para in q.paragraphs]), tmp, protocol=pickle.HIGHEST_PROTOCOL)
+                add_to_histogram(hist, q)
+                yield q
+        complete = True
+    finally:
+        if complete:
+            write_rating_stats(_stats_entry(entry), digest, hist)
+            os.replace(tmp.name, entry)
+            evict_cache(cache_dir, max_bytes, keep=entry)
+        else:
+            os.unlink(tmp.name)
+
+def read_query_grades(path: Path, **cache_args) -> List[QueryGrades]:
+    """Load the indexed self-ratings of all queries of a judgements file, see iter_cached_query_grades."""
+    return list(iter_cached_query_grades(path, **cache_args))
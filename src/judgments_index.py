@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import argparse
+import gzip
+import json
+import logging
+import os
+
+from judgments import QueryId, QueryGrades, RatingHistogram, add_to_histogram, file_digest, parse_query_grades
+
+# An indexed judgements file is a JSONL.gz file with every query (line) compressed as its own
+# gzip member. Concatenated members are still one valid gzip stream, so exam_pp and every other
+# reader see the same file, while a query can be decompressed on its own from its byte range.
+INDEX_FORMAT_VERSION = 2
+
+class IndexEntry(NamedTuple):
+    """Byte range of the gzip member holding one query."""
+    query_id: QueryId
+    offset: int
+    length: int
+
+class JudgementsIndex(NamedTuple):
+    """Sidecar of an indexed judgements file (see index_path)."""
+    size: int                     # size, modification time and content hash (judgments.file_digest)
+    mtime_ns: int                 # of the indexed file, to detect a replaced file
+    digest: str
+    entries: List[IndexEntry]     # in file order
+    histogram: RatingHistogram    # rating statistics of all queries, see judgments.add_to_histogram
+
+def index_path(path: Path) -> Path:
+    return path.with_name(path.name + '.index.json')
+
+def write_index(path: Path, index: JudgementsIndex):
+    sidecar = index_path(path)
+    tmp_path = sidecar.with_name(sidecar.name + '.tmp')
+    with tmp_path.open('w') as f:
+        json.dump({
+            'version': INDEX_FORMAT_VERSION,
+            'size': index.size,
+            'mtime_ns': index.mtime_ns,
+            'digest': index.digest,
+            'queries': [list(entry) for entry in index.entries],
+            'histogram': index.histogram,
+        }, f)
+    os.replace(tmp_path, sidecar)
+
+def read_index(path: Path) -> Optional[JudgementsIndex]:
+    """
+    The index of a judgements file, None if it has none or the file changed since it was indexed.
+    The file is only hashed when its modification time differs from the indexed one.
+    """
+    sidecar = index_path(path)
+    try:
+        with sidecar.open('r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    if data.get('version') != INDEX_FORMAT_VERSION:
+        logging.warning(f"Ignoring {sidecar}: index format {data.get('version')}, expected {INDEX_FORMAT_VERSION}")
+        return None
+    stat = path.stat()
+    if data['size'] != stat.st_size or (data['mtime_ns'] != stat.st_mtime_ns and data['digest'] != file_digest(path)):
+        logging.warning(f"Ignoring {sidecar}: {path} changed since it was indexed")
+        return None
+    histogram = {question_id: {int(r): n for r, n in counts.items()} for question_id, counts in data['histogram'].items()}
+    return JudgementsIndex(data['size'], data['mtime_ns'], data['digest'],
+                           [IndexEntry(*entry) for entry in data['queries']], histogram)
+
+def rewrite_indexed(source: Path, output: Path, compresslevel: int = 6, lean: bool = False) -> JudgementsIndex:
+    """
+    Rewrite a judgements file with one gzip member per query and write its index sidecar.
+
+    The rating histogram of all queries is stored in the index, so the features of a
+    subset of the queries are the same as in a run over the whole file. `output` may be
+    `source` itself. A truncated source is handled like judgments.iter_judgements.
+
+    Args:
+        source: Path to the exampp judgements file (JSONL.gz).
+        output: Path of the indexed judgements file.
+        compresslevel: gzip compression level of the members.
+        lean: Parse the queries with judgments.lean_query_grades instead of exam_pp.
+    """
+    tmp_path = output.with_name(output.name + '.tmp')
+    entries = []
+    hist: RatingHistogram = {}
+    offset = 0
+    with gzip.open(source, 'rb') as src, tmp_path.open('wb') as dst:
+        try:
+            for line in src:
+                if not line.strip():
+                    continue
+                q = parse_query_grades(line, lean)
+                add_to_histogram(hist, q)
+                member = gzip.compress(line if line.endswith(b'\n') else line + b'\n', compresslevel=compresslevel, mtime=0)
+                dst.write(member)
+                entries.append(IndexEntry(q.query_id, offset, len(member)))
+                offset += len(member)
+        except EOFError as e:
+            logging.warning(f"Truncated judgements file {source}, indexing the queries read so far: {e}")
+    os.replace(tmp_path, output)
+    index = JudgementsIndex(offset, output.stat().st_mtime_ns, file_digest(output), entries, hist)
+    write_index(output, index)
+    return index
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a shard given as 'i/N' (0 <= i < N), for argparse."""
+    try:
+        i, n = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must be given as i/N, got {value!r}")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {n}), got {i}")
+    return i, n
+
+def select_entries(
+    index: JudgementsIndex,
+    query_ids: Optional[Sequence[QueryId]] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    max_query: Optional[int] = None
+) -> List[IndexEntry]:
+    """
+    The entries of the selected queries, in file order.
+
+    Args:
+        index: Index of the judgements file.
+        query_ids: Only these queries (all if None).
+        shard: (i, N): the i-th of N contiguous, equally sized parts of the (selected)
+            queries, so the outputs of shards 0..N-1 concatenate to that of a single run.
+        max_query: At most this many of the remaining queries.
+    """
+    entries = index.entries
+    if query_ids is not None:
+        wanted = set(query_ids)
+        missing = wanted - {entry.query_id for entry in entries}
+        if missing:
+            logging.warning(f"Queries not in the judgements file: {sorted(missing)}")
+        entries = [entry for entry in entries if entry.query_id in wanted]
+    if shard is not None:
+        i, n = shard
+        entries = entries[len(entries) * i // n:len(entries) * (i + 1) // n]
+    if max_query:
+        entries = entries[:max_query]
+    return entries
+
+def iter_indexed_query_grades(path: Path, entries: Sequence[IndexEntry], lean: bool = False) -> Iterator[QueryGrades]:
+    """Decompress and parse only the queries of `entries` from an indexed judgements file."""
+    with path.open('rb') as f:
+        for entry in entries:
+            f.seek(entry.offset)
+            yield parse_query_grades(gzip.decompress(f.read(entry.length)), lean)
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite a judgements file with one gzip member per query and write a query index next to it, for build_feature_vectors.py --query-ids / --shard")
+    parser.add_argument('--judgements', '-j', type=Path, required=True, help='exampp judgements file (JSONL.gz)')
+    parser.add_argument('--output', '-o', type=Path, required=False, help='Indexed judgements file (default: rewrite the judgements file in place)')
+    parser.add_argument('--compresslevel', type=int, default=6, help='gzip compression level (default: 6)')
+    parser.add_argument('--lean-reader', action='store_true', help='Parse the judgements without the exam_pp data model')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    output = args.output or args.judgements
+    index = rewrite_indexed(args.judgements, output, args.compresslevel, args.lean_reader)
+    logging.info(f"Indexed {len(index.entries)} queries of {args.judgements} into {output} ({index.size} bytes) and {index_path(output)}")
+
+if __name__ == "__main__":
+    main()
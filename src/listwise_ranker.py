@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import argparse
+import logging
+import time
+import numpy as np
+
+from run_io import Run, RunVocab
+from trec_metrics import Qrels, read_qrels
+from feature_join import DEFAULT_FEATURE_VALUE, JoinedFeatures, JoinedSystem, build_index, join_system
+# Steps tried for one weight in a coordinate ascent line search, relative to the L1-normalized weights
+LINE_SEARCH_STEPS = np.array([-2.0, -1.0, -0.5, -0.1, -0.01, 0.01, 0.1, 0.5, 1.0, 2.0])
+MAX_ITERATIONS = 25
+OUT_PREFIX = 'cv-5fold'
+
+class RankingData(NamedTuple):
+    """Candidate documents of one system: rows grouped by query, in the order of the base run."""
+    run: Run                  # base run (qid, docid and score of every row)
+    features: np.ndarray      # (rows, features), missing values already defaulted
+    feature_names: List[str]
+    rels: np.ndarray          # relevance grade per row (0 for unjudged documents)
+
+class PaddedQueries(NamedTuple):
+    """Queries as (queries, max_docs) blocks, so a ranking of all queries is one sort along the last axis."""
+    qids: np.ndarray          # qid code per query
+    rows: np.ndarray          # (queries, max_docs) row index into the RankingData, -1 for padding
+    features: np.ndarray      # (queries, max_docs, features)
+    relevant: np.ndarray      # (queries, max_docs) bool
+    num_rel: np.ndarray       # relevant documents per query in the qrels
+
+class SystemFolds(NamedTuple):
+    """Cross-validation split of the judged queries of one system."""
+    system: str
+    data: RankingData
+    query_codes: np.ndarray   # judged queries ranked by the system
+    fold_of: np.ndarray       # fold of every query in query_codes
+    num_rel: np.ndarray       # relevant documents per qid code in the qrels
+
+class FoldResult(NamedTuple):
+    system: str
+    fold: int
+    feature_names: List[str]
+    weights: np.ndarray
+    train_map: float
+    test_map: Optional[float]  # None for a fold without test queries
+    test_lines: List[str]
+
+def ranking_data(joined: JoinedSystem, qrels: Qrels) -> RankingData:
+    return RankingData(joined.run, joined.features, joined.feature_names, qrels.lookup(joined.run))
+
+def assign_folds(query_codes: np.ndarray, n_folds: int, seed: int) -> np.ndarray:
+    """Fold number of every query: a seeded shuffle dealt round-robin, so folds differ in size by at most one."""
+    fold_of = np.empty(len(query_codes), dtype=np.int64)
+    fold_of[np.random.default_rng(seed).permutation(len(query_codes))] = np.arange(len(query_codes)) % n_folds
+    return fold_of
+
+def pad_queries(data: RankingData, query_codes: np.ndarray, num_rel: np.ndarray) -> PaddedQueries:
+    rows_of = {code: np.flatnonzero(data.run.qids == code) for code in query_codes.tolist()}
+    width = max((len(rows) for rows in rows_of.values()), default=0)
+    rows = np.full((len(query_codes), width), -1, dtype=np.int64)
+    for i, code in enumerate(query_codes.tolist()):
+        rows[i, :len(rows_of[code])] = rows_of[code]
+    valid = rows >= 0
+    features = np.where(valid[:, :, None], data.features[rows], 0.0)
+    relevant = valid & (data.rels[rows] >= 1)
+    return PaddedQueries(query_codes, rows, features, relevant, num_rel[query_codes])
+
+def mean_average_precision(queries: PaddedQueries, weights: np.ndarray) -> np.ndarray:
+    """
+    MAP of linear models over the padded queries, for a (models, features) weight matrix at once.
+    Average precision is over all relevant documents in the qrels, as in trec_eval.
+    """
+    return map_of_scores(queries, np.einsum('qdf,kf->kqd', queries.features, weights))
+
+def map_of_scores(queries: PaddedQueries, scores: np.ndarray) -> np.ndarray:
+    """MAP of each of a (models, queries, max_docs) batch of document scores."""
+    scores = np.where(queries.rows < 0, -np.inf, scores)
+    order = np.argsort(-scores, axis=2, kind='stable')
+    relevant = np.take_along_axis(np.broadcast_to(queries.relevant, scores.shape), order, axis=2)
+    precision = np.cumsum(relevant, axis=2) / np.arange(1, scores.shape[2] + 1)
+    ap = np.divide((precision * relevant).sum(axis=2), queries.num_rel,
+                   out=np.zeros(scores.shape[:2]), where=queries.num_rel > 0)
+    return ap.mean(axis=1) if ap.shape[1] else np.zeros(len(scores))
+
+def normalize(weights: np.ndarray) -> np.ndarray:
+    norm = np.abs(weights).sum(axis=-1, keepdims=True)
+    return np.divide(weights, norm, out=np.zeros_like(weights), where=norm > 0)
+
+def train_coordinate_ascent(queries: PaddedQueries, restarts: int, threshold: float, rng: np.random.Generator) -> Tuple[np.ndarray, float]:
+    """
+    Coordinate ascent on training MAP: each weight in turn is moved by the line search step
+    that improves MAP most, until an iteration over all weights gains less than `threshold`.
+    The first start uses uniform weights, further restarts random ones; the best model wins.
+
+    All steps of a line search are evaluated as one batch. Weights are kept L1-normalized,
+    which does not change rankings, so a candidate's scores are the current scores plus the
+    step times the feature column. Features that are constant within every query cannot
+    change a ranking and are not searched.
+    """
+    n_features = queries.features.shape[2]
+    valid = queries.rows >= 0
+    lowest = np.where(valid[:, :, None], queries.features, np.inf).min(axis=1, initial=np.inf)
+    highest = np.where(valid[:, :, None], queries.features, -np.inf).max(axis=1, initial=-np.inf)
+    active = np.flatnonzero((highest > lowest).any(axis=0))
+    steps = LINE_SEARCH_STEPS[:, None, None]
+
+    best_weights, best_map = np.full(n_features, 1.0 / n_features), -1.0
+    for restart in range(restarts):
+        weights = normalize(np.full(n_features, 1.0) if restart == 0 else rng.uniform(-1, 1, n_features))
+        scores = queries.features @ weights
+        current = map_of_scores(queries, scores[None])[0]
+        for _ in range(MAX_ITERATIONS):
+            start = current
+            for feature in rng.permutation(active):
+                maps = map_of_scores(queries, scores[None] + steps * queries.features[:, :, feature])
+                best = int(np.argmax(maps))
+                if maps[best] > current:
+                    weights = weights.copy()
+                    weights[feature] += LINE_SEARCH_STEPS[best]
+                    weights = normalize(weights)
+                    scores = queries.features @ weights
+                    current = maps[best]
+            if current - start < threshold:
+                break
+        if current > best_map:
+            best_weights, best_map = weights, current
+    return best_weights, best_map
+
+def zscore(train: np.ndarray, *others: np.ndarray) -> List[np.ndarray]:
+    """Standardize features with the mean and deviation of the training rows."""
+    mean = train.mean(axis=0)
+    std = train.std(axis=0)
+    std[std == 0] = 1.0
+    return [(x - mean) / std for x in (train,) + others]
+
+def ranked_run_lines(data: RankingData, queries: PaddedQueries, weights: np.ndarray, tag: str) -> List[str]:
+    """Run lines of the queries ranked by the model, ranks starting at 1."""
+    scores = queries.features @ weights
+    scores[queries.rows < 0] = -np.inf
+    order = np.argsort(-scores, axis=1, kind='stable')
+    lines = []
+    for i, code in enumerate(queries.qids.tolist()):
+        qid = data.run.vocab.qids.strings[code]
+        for rank, j in enumerate(order[i, :int((queries.rows[i] >= 0).sum())], 1):
+            docid = data.run.vocab.docids.strings[data.run.docids[queries.rows[i, j]]]
+            lines.append(f"{qid} Q0 {docid} {rank} {scores[i, j]:.6f} {tag}\n")
+    return lines
+
+def split_folds(system: str, data: RankingData, qrels: Qrels, n_folds: int, seed: int) -> SystemFolds:
+    """Assign the queries of a system that have judgments to `n_folds` folds."""
+    query_codes = np.intersect1d(np.unique(data.run.qids), qrels.judged_qids)
+    num_rel = np.bincount(qrels.qids[qrels.rels >= 1], minlength=len(qrels.vocab.qids))
+    return SystemFolds(system, data, query_codes, assign_folds(query_codes, n_folds, seed), num_rel)
+
+def fold_queries(folds: SystemFolds, fold: int, use_zscore: bool) -> Tuple[PaddedQueries, PaddedQueries]:
+    """Training (all folds but `fold`) and test queries of a fold, standardized with the training rows if `use_zscore`."""
+    train = pad_queries(folds.data, folds.query_codes[folds.fold_of != fold], folds.num_rel)
+    test = pad_queries(folds.data, folds.query_codes[folds.fold_of == fold], folds.num_rel)
+    if use_zscore:
+        train_rows, test_rows = train.rows >= 0, test.rows >= 0
+        train_features, test_features = train.features.copy(), test.features.copy()
+        train_features[train_rows], test_features[test_rows] = zscore(train.features[train_rows], test.features[test_rows])
+        train, test = train._replace(features=train_features), test._replace(features=test_features)
+    return train, test
+
+def has_training_queries(folds: SystemFolds) -> bool:
+    """Whether every fold leaves queries to train on: the system has at least two judged queries."""
+    return len(folds.query_codes) >= 2 and int(folds.fold_of.max()) > 0
+
+def cross_validate_fold(folds: SystemFolds, fold: int, restarts: int, threshold: float, use_zscore: bool, seed: int) -> Optional[FoldResult]:
+    """
+    Train on all folds but `fold` and rank the queries of `fold` with the learned model.
+    None if no query is left to train on (see has_training_queries).
+    """
+    if not has_training_queries(folds):
+        return None
+    train, test = fold_queries(folds, fold, use_zscore)
+    rng = np.random.default_rng([seed, fold])
+    weights, train_map = train_coordinate_ascent(train, restarts, threshold, rng)
+    test_map = float(mean_average_precision(test, weights[None])[0]) if len(test.qids) else None
+    return FoldResult(folds.system, fold, folds.data.feature_names, weights, float(train_map), test_map,
+                      ranked_run_lines(folds.data, test, weights, OUT_PREFIX))
+
+class FeatureSource:
+    """
+    Qrels and the joined features of the systems of a ranker context (see ranker_context):
+    from the joined file, or joined with each base run when it is loaded. Every worker
+    process holds one; the folds of the last loaded system are kept, so the folds of a
+    system that land on the same worker share the join.
+    """
+
+    def __init__(self, context: dict):
+        self.context = context
+        vocab = RunVocab()
+        self.qrels = read_qrels(context['qrel'], vocab)
+        if context['joined'] is not None:
+            self.joined_features, self.index = JoinedFeatures(context['joined']), None
+        else:
+            self.joined_features, self.index = None, build_index(vocab, context['feature_run_dir'], context['features'], context['default'])
+        self.last: Optional[SystemFolds] = None
+
+    def load_system(self, system: str) -> RankingData:
+        """One system's joined features, from the joined file or joined with its base run now."""
+        if self.joined_features is not None:
+            joined = self.joined_features.system(system, self.qrels.vocab)
+        else:
+            joined = join_system(self.context['base_runs'][system], self.index, self.context['default'])
+        return ranking_data(joined, self.qrels)
+
+    def system_folds(self, system: str) -> SystemFolds:
+        if self.last is None or self.last.system != system:
+            self.last = split_folds(system, self.load_system(system), self.qrels, self.context['folds'], self.context['seed'])
+        return self.last
+
+# Shared by the fold tasks of a worker process
+_source: Optional[FeatureSource] = None
+
+def _init_worker(context: dict):
+    global _source
+    _source = FeatureSource(context)
+
+def _fold_task(task: Tuple[str, int]) -> Optional[FoldResult]:
+    system, fold = task
+    context = _source.context
+    return cross_validate_fold(_source.system_folds(system), fold, context['restarts'], context['threshold'],
+                               context['zscore'], context['seed'])
+
+def write_system_results(output_dir: Path, results: List[FoldResult]):
+    """Write cv-5fold-run-test.run (test queries of all folds) and MAP_scores.txt of one system."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results = sorted(results, key=lambda r: r.fold)
+    with (output_dir / f"{OUT_PREFIX}-run-test.run").open('w') as f:
+        for result in results:
+            f.writelines(result.test_lines)
+    with (output_dir / 'MAP_scores.txt').open('w') as f:
+        f.write(f"Train/Test MAP scores for {results[0].system}:\n")
+        for result in results:
+            f.write(f"Model train train metric fold {result.fold}: MAP {result.train_map:.4f}\n")
+            if result.test_map is not None:
+                f.write(f"Model test test metric fold {result.fold}: MAP {result.test_map:.4f}\n")
+        f.write(f"Model test test metric mean: MAP {mean_test_map(results):.4f}\n")
+        f.write("Weights (mean over folds):\n")
+        for name, weight in zip(results[0].feature_names, np.mean([r.weights for r in results], axis=0)):
+            f.write(f"{name}\t{weight:.6f}\n")
+
+def mean_test_map(results: List[FoldResult]) -> float:
+    """Mean test MAP over the folds with test queries."""
+    return float(np.mean([r.test_map for r in results if r.test_map is not None]))
+
+def rerank_systems(systems: List[str], context: dict, output_root: Path, workers: int):
+    """Run the cross-validation folds of all systems, `workers` (system, fold) tasks at a time."""
+    tasks = [(system, fold) for system in systems for fold in range(context['folds'])]
+    pending: Dict[str, List[Optional[FoldResult]]] = {}
+
+    def collect(system: str, result: Optional[FoldResult]):
+        pending.setdefault(system, []).append(result)
+        if len(pending[system]) == context['folds']:
+            results = pending.pop(system)
+            if any(r is None for r in results):
+                logging.warning(f"Skipping {system}: fewer than two of its queries are judged, no fold has queries to train on")
+                return
+            write_system_results(output_root / system, results)
+            logging.info(f"Reranked {system}: test MAP {mean_test_map(results):.4f}")
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(context,)) as pool:
+            for (system, _), result in zip(tasks, pool.map(_fold_task, tasks)):
+                collect(system, result)
+    else:
+        _init_worker(context)
+        for task in tasks:
+            collect(task[0], _fold_task(task))
+
+def add_ranker_arguments(parser: argparse.ArgumentParser):
+    """Feature source, qrels and cross-validation options of the ranker (see ranker_context)."""
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--joined", type=Path, help="Joined features of all systems (.npz from feature_join.py)")
+    source.add_argument("--feature-run-dir", type=Path, help="Directory with the criterion *.run files, joined with the base runs in memory")
+    source.add_argument("--features", type=Path, help="Feature store directory (--store-dir) or sparse RankLib file, joined with the base runs in memory")
+    parser.add_argument("--base-run-dir", type=Path, help="Directory with the base system *.run files (required unless --joined)")
+    parser.add_argument("--qrel", "-q", required=True, type=Path, help="Qrels used for training and evaluation (grades >= 1 are relevant)")
+    parser.add_argument("--folds", type=int, default=5, help="Cross-validation folds (default: 5)")
+    parser.add_argument("--restarts", type=int, default=10, help="Coordinate ascent restarts (default: 10)")
+    parser.add_argument("--convergence-threshold", type=float, default=0.0001, help="Minimum MAP gain of an iteration (default: 0.0001)")
+    parser.add_argument("--default-any-feature-value", type=float, default=DEFAULT_FEATURE_VALUE, help=f"Value of missing features (default: {DEFAULT_FEATURE_VALUE})")
+    parser.add_argument("--no-z-score", action='store_true', help="Do not standardize features")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for folds and restarts (default: 0)")
+
+def ranker_context(parser: argparse.ArgumentParser, args: argparse.Namespace) -> Tuple[List[str], dict]:
+    """The systems to rerank and the worker context (see FeatureSource) of the add_ranker_arguments options."""
+    if args.joined is not None:
+        base_runs = {}
+        with np.load(args.joined) as data:
+            systems = data['systems'].tolist()
+    elif args.base_run_dir is None:
+        parser.error("--base-run-dir is required with --feature-run-dir or --features")
+    else:
+        base_runs = {path.stem: path for path in sorted(args.base_run_dir.glob("*.run"))}
+        systems = list(base_runs)
+    context = {
+        'qrel': args.qrel, 'joined': args.joined, 'feature_run_dir': args.feature_run_dir, 'features': args.features,
+        'base_runs': base_runs, 'default': args.default_any_feature_value,
+        'folds': args.folds, 'restarts': args.restarts, 'threshold': args.convergence_threshold,
+        'zscore': not args.no_z_score, 'seed': args.seed,
+    }
+    return systems, context
+
+def main():
+    parser = argparse.ArgumentParser(description="Rerank base system runs with a coordinate ascent listwise model on MAP, with k-fold cross-validation (in-process replacement for the Rank-LiPS loop)")
+    add_ranker_arguments(parser)
+    parser.add_argument("--output-root", required=True, type=Path, help="Output directory, one subdirectory per system")
+    parser.add_argument("--workers", type=int, default=1, help="Number of (system, fold) models trained in parallel")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    systems, context = ranker_context(parser, args)
+    start = time.time()
+    logging.info(f"Reranking {len(systems)} systems with {args.folds}-fold cross-validation")
+    rerank_systems(systems, context, args.output_root, args.workers)
+    logging.info(f"Done in {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
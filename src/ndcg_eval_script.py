@@ -1,8 +1,18 @@
+import hashlib
+import json
 import os
 import subprocess
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import numpy as np
+
+from run_io import Run, parse_run_line, read_run
+from results_store import ORIGINAL_JUDGE, ResultsStore
+from significance import BEFORE_SUFFIX, system_name, write_significance
+from trec_metrics import read_qrels, rank_run, metric_matrix, mean_over_queries, build_metric_matrix, save_metric_matrix
+
 # ===== Configuration ===== #
 QRELS_PATH = "/home/nf1104/work/data/dl/data/dl2019/2019qrels-pass.txt"
 BASE_DIR = "/home/nf1104/work/Summer 25/LTR_Rubric/ranklips-results/flant5/dl19"
@@ -15,6 +25,22 @@ SUMMARY_BEFORE = "ndcg_summary_before_flant5.txt"
 SUMMARY_AFTER = "ndcg_summary_after_flant5.txt"
 LOG_FILE = "ndcg_evaluation.log"
 
+WORKERS = os.cpu_count() or 1  # Processes evaluating runs in parallel
+CROSS_CHECK_TREC_EVAL = False  # Also run trec_eval on every run and log disagreements
+EVAL_CACHE = "ndcg_eval_cache.json"  # Scores of already evaluated runs; set to None to re-evaluate everything
+
+# Metrics computed per query in one pass over each run (trec_eval names, see trec_metrics.parse_metric)
+METRICS = ["ndcg_cut_20", "ndcg_cut_10", "ndcg_cut_5", "ndcg", "map", "recip_rank", "P_10", "P_20"]
+SUMMARY_METRIC = "ndcg_cut_20"  # Written to the summary files; must be one of METRICS
+PER_QUERY_BEFORE = "per_query_before_flant5.npz"  # runs x queries x metrics; set to None to skip
+PER_QUERY_AFTER = "per_query_after_flant5.npz"
+SIGNIFICANCE_AFTER = "ndcg_significance_after_flant5.txt"  # Paired tests of SUMMARY_METRIC, after vs before; set to None to skip
+
+# Results store shared by all evaluations (see results_store.py); set to None to skip
+RESULTS_STORE = "results.sqlite"
+DATASET = "dl19"
+JUDGE = "flant5"  # Judge model of the reranked runs; the original runs are stored under results_store.ORIGINAL_JUDGE
+
 # ===== Utilities ===== #
 def log_message(message, log_path=LOG_FILE):
     print(message)
@@ -25,101 +51,142 @@ def clear_files(file_paths):
     for path in file_paths:
         open(path, 'w').close()
 
-def is_number(value):
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
+class RunLog:
+    """
+    Log output of one run's evaluation, kept in memory and appended to the log file by
+    the parent process, so runs evaluated in parallel do not interleave their lines.
+    """
+
+    def __init__(self):
+        self.entries = []  # (text, echo to stdout)
+        self.malformed = 0  # Malformed lines skipped while the run was read
+
+    def message(self, message):
+        self.entries.append((f"{message}\n", True))
+
+    def raw(self, text, at=None):
+        self.entries.insert(len(self.entries) if at is None else at, (text, False))
+
+    def flush(self, log_path=LOG_FILE):
+        for text, echo in self.entries:
+            if echo:
+                print(text, end='')
+        with open(log_path, 'a') as logf:
+            logf.write("".join(text for text, _ in self.entries))
+        self.entries = []
+
+def file_digest(path):
+    """Content hash (BLAKE2b) of a file, read in 1 MiB blocks."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+class EvalCache:
+    """
+    Persistent scores of evaluated runs, keyed by the content hashes of the run and the
+    qrels plus the evaluation settings, so only new or modified runs are scored again.
+    The log of the evaluation (run preview, malformed lines) is kept with the scores and
+    logged again for a cached run. File hashes are remembered by (size, mtime) and only
+    recomputed when a file changes.
+    """
+    VERSION = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}  # absolute path -> [size, mtime_ns, digest]
+        self.scores = {}  # key -> {'scores': {qid: [value per metric]}, 'log': RunLog entries, 'malformed': count}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.hashes = data['hashes']
+                    self.scores = data['scores']
+            except (OSError, ValueError, KeyError) as e:
+                log_message(f"Warning: ignoring unreadable evaluation cache {path}: {e}")
+
+    def digest(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        memo = self.hashes.get(path)
+        if memo is not None and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+        digest = file_digest(path)
+        self.hashes[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def key(self, run_file, qrels_path, clean, max_queries, max_docs_per_query, metrics=METRICS):
+        """Cache key of a run's evaluation, or None if the run cannot be read."""
+        try:
+            run_digest = self.digest(run_file)
+        except OSError:
+            return None
+        # The document limit only applies to cleaned runs
+        max_docs = max_docs_per_query if clean else None
+        return f"{run_digest}|{self.digest(qrels_path)}|{','.join(metrics)}|{int(clean)}|{max_queries}|{max_docs}"
+
+    def get(self, key):
+        return self.scores.get(key) if key is not None else None
+
+    def put(self, key, scores, run_log):
+        """Cache the scores of a run and its log, except for the 'Evaluating' line that starts it."""
+        if key is not None and scores is not None:
+            self.scores[key] = {'scores': scores, 'log': run_log.entries[1:], 'malformed': run_log.malformed}
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION, 'hashes': self.hashes, 'scores': self.scores}, f)
+        os.replace(tmp_path, self.path)
 
 # ===== Run File Cleaning ===== #
-def clean_run(input_path, output_path, log_path, max_docs_per_query=None):
-    if not os.path.isfile(input_path) or not os.access(input_path, os.R_OK):
-        log_message(f"Error: Cannot read {input_path}", log_path)
-        return False
-
-    if os.path.getsize(input_path) == 0:
-        log_message(f"Error: File {input_path} is empty", log_path)
-        return False
-
-    with open(log_path, 'a') as lf, open(input_path, 'r') as infile:
-        lf.write(f"First 5 lines of {input_path}:\n")
-        for i, line in enumerate(infile):
-            if i >= 5: break
-            lf.write(line)
-        lf.write("-" * 24 + "\n")
-
-    try:
-        with open(input_path, 'r') as infile, open(output_path, 'w') as outfile:
-            doc_count = 0
-            prev_qid = None
-
-            for line_num, line in enumerate(infile, 1):
-                line = line.strip()
-                if not line:
-                    log_message(f"Skipping empty line {line_num} in {input_path}", log_path)
-                    continue
-
-                fields = line.split()
-                if len(fields) >= 6:
-                    qid = fields[0]
-                    if qid != prev_qid:
-                        doc_count = 0
-                    # Only apply doc limit if max_docs_per_query is not None
-                    if max_docs_per_query is None or doc_count < max_docs_per_query:
-                        outfile.write(line + '\n')
-                        doc_count += 1
-                    prev_qid = qid
-                elif len(fields) >= 3:
-                    qid = fields[0]
-                    docid = fields[2]
-                    rank = fields[3] if len(fields) > 3 and fields[3].isdigit() else "1000"
-                    score = fields[4] if len(fields) > 4 and is_number(fields[4]) else "0.0"
-                    tag = fields[5] if len(fields) > 5 else "AUTO"
-                    reconstructed = f"{qid} Q0 {docid} {rank} {score} {tag}"
-                    if qid != prev_qid:
-                        doc_count = 0
-                    # Only apply doc limit if max_docs_per_query is not None
-                    if max_docs_per_query is None or doc_count < max_docs_per_query:
-                        outfile.write(reconstructed + '\n')
-                        doc_count += 1
-                    prev_qid = qid
+def iter_clean_run(input_path, run_log, max_docs_per_query=None):
+    """
+    Stream the repaired lines of a run in a single pass over the file: malformed lines are
+    fixed or skipped (see run_io.parse_run_line), at most `max_docs_per_query` lines are kept
+    per block of consecutive lines of a query, and the first 5 lines are logged.
+    Raises OSError if the file cannot be read.
+    """
+    preview_at = len(run_log.entries)
+    preview = []
+    doc_count = 0
+    prev_qid = None
+    with open(input_path, 'r') as infile:
+        for line_num, line in enumerate(infile, 1):
+            if line_num <= 5:
+                preview.append(line)
+            parsed = parse_run_line(line, lenient=True)
+            if parsed is None:
+                if not line.strip():
+                    run_log.message(f"Skipping empty line {line_num} in {input_path}")
                 else:
-                    log_message(f"Malformed line {line_num} in {input_path}: {line}", log_path)
-    except Exception as e:
-        log_message(f"Error processing {input_path}: {e}", log_path)
-        return False
-
-    if os.path.getsize(output_path) == 0:
-        log_message(f"Error: Output file {output_path} is empty", log_path)
-        return False
-
-    return True
+                    run_log.message(f"Malformed line {line_num} in {input_path}: {line.strip()}")
+                    run_log.malformed += 1
+                continue
+            qid = parsed[0]
+            if qid != prev_qid:
+                doc_count = 0
+            prev_qid = qid
+            # Only apply doc limit if max_docs_per_query is not None
+            if max_docs_per_query is None or doc_count < max_docs_per_query:
+                doc_count += 1
+                yield parsed
+    if preview:
+        # The preview precedes the messages about malformed lines, as if it was logged first
+        run_log.raw(f"First 5 lines of {input_path}:\n" + "".join(preview) + "-" * 24 + "\n", at=preview_at)
 
 # ===== Evaluation ===== #
-def limit_queries(input_path, max_queries=None):
-    # If max_queries is None, return the original file path
+def limit_run(run, max_queries=None):
+    """Keep the lines of the first `max_queries` distinct queries of a run."""
     if max_queries is None:
-        return input_path
-    
-    output = tempfile.NamedTemporaryFile(mode='w', delete=False)
-    seen_qids = set()
-    count = 0
-
-    with open(input_path, 'r') as infile, open(output.name, 'w') as outfile:
-        for line in infile:
-            fields = line.strip().split()
-            if not fields:
-                continue
-            qid = fields[0]
-            if qid not in seen_qids:
-                count += 1
-                seen_qids.add(qid)
-                if count > max_queries:
-                    continue
-            outfile.write(line)
-
-    return output.name
+        return run
+    _, first_rows = np.unique(run.qids, return_index=True)
+    allowed = run.qids[np.sort(first_rows)[:max_queries]]
+    return run.select(np.isin(run.qids, allowed))
 
 def extract_ndcg_from_output(output_str):
     for line in output_str.splitlines():
@@ -129,84 +196,192 @@ def extract_ndcg_from_output(output_str):
                 return parts[2]
     return None
 
-def run_trec_eval(qrels_path, run_path, log_path):
+def trec_eval_ndcg(qrels_path, run_path):
+    """nDCG@20 of a run file as reported by trec_eval (None if it fails), and trec_eval's stderr."""
     result = subprocess.run(['trec_eval', '-m', 'ndcg_cut.20', qrels_path, run_path],
                             capture_output=True, text=True)
-    with open(log_path, 'a') as logf:
-        if result.stderr:
-            logf.write(result.stderr)
-    return result
-
-def evaluate_run(run_file, summary_file, file_label, clean=True, qrels_path=QRELS_PATH, log_path=LOG_FILE, output_file=None, max_queries=None, max_docs_per_query=None):
-    log_message(f"Evaluating: {run_file}", log_path)
-    cleaned_path = run_file
-
-    if clean:
-        temp_clean = tempfile.NamedTemporaryFile(mode='w', delete=False)
-        temp_clean.close()
-        if not clean_run(run_file, temp_clean.name, log_path, max_docs_per_query):
-            os.unlink(temp_clean.name)
-            return False
-        cleaned_path = temp_clean.name
-
-    if os.path.getsize(cleaned_path) == 0:
-        log_message(f"Error: {cleaned_path} is empty", log_path)
+    return (extract_ndcg_from_output(result.stdout) if result.returncode == 0 else None), result.stderr
+
+# Qrels are read once per file and shared by all evaluated runs
+_qrels_cache = {}
+
+def load_qrels(qrels_path):
+    if qrels_path not in _qrels_cache:
+        _qrels_cache[qrels_path] = read_qrels(qrels_path)
+    return _qrels_cache[qrels_path]
+
+def cross_check_with_trec_eval(run, ndcg, qrels_path, run_log):
+    """Score the (cleaned, limited) run's nDCG@20 with trec_eval as well and log any disagreement."""
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.run') as tmp:
+        tmp.write("".join(run.lines()))
+        tmp.flush()
+        expected, stderr = trec_eval_ndcg(qrels_path, tmp.name)
+    if stderr:
+        run_log.raw(stderr)
+    if expected != ndcg:
+        run_log.message(f"Warning: trec_eval reports nDCG@20 {expected}, native evaluator {ndcg}")
+
+def score_run(run_file, file_label, clean=True, qrels_path=QRELS_PATH, output_file=None, max_queries=None, max_docs_per_query=None, metrics=METRICS, cross_check=CROSS_CHECK_TREC_EVAL):
+    """
+    Compute `metrics` for every query of a run in-process (see trec_metrics), without
+    temp files or trec_eval; the run is ranked once for all metrics.
+
+    With `clean`, the run is repaired while it is read (iter_clean_run) and the per-query
+    document limit applies. Nothing is written to the summary or log files: returns
+    (file_label, {qid: [value per metric]} or None on failure, RunLog) for the caller to record.
+    """
+    run_log = RunLog()
+    run_log.message(f"Evaluating: {run_file}")
+
+    qrels = load_qrels(qrels_path)
+    try:
         if clean:
-            os.unlink(cleaned_path)
-        return False
+            run = Run.from_lines(iter_clean_run(run_file, run_log, max_docs_per_query), qrels.vocab)
+        else:
+            run = read_run(run_file, qrels.vocab)
+    except OSError as e:
+        run_log.message(f"Error: Cannot read {run_file}: {e}")
+        return file_label, None, run_log
+    except Exception as e:
+        run_log.message(f"Error processing {run_file}: {e}")
+        return file_label, None, run_log
 
-    limited_path = limit_queries(cleaned_path, max_queries)
+    if len(run) == 0:
+        run_log.message(f"Error: {run_file} is empty")
+        return file_label, None, run_log
 
-    result = run_trec_eval(qrels_path, limited_path, log_path)
+    run = limit_run(run, max_queries=max_queries)
+    ranked = rank_run(run, qrels)
+    values = metric_matrix(ranked, qrels, metrics)
+    scores = dict(zip(qrels.vocab.qids.decode(ranked.query_codes), values.tolist()))
+    if cross_check and "ndcg_cut_20" in metrics:
+        ndcg = f"{summarize(scores, metrics)['ndcg_cut_20']:.4f}"
+        cross_check_with_trec_eval(run, ndcg, qrels_path, run_log)
 
-    if result.returncode != 0:
-        log_message(f"Error: trec_eval failed for {run_file}", log_path)
-        return False
-
-    ndcg = extract_ndcg_from_output(result.stdout)
-    if ndcg is None:
-        log_message(f"Error: Could not parse nDCG from trec_eval output for {run_file}", log_path)
-        return False
+    if output_file:
+        write_score_file(output_file, scores, metrics)
 
-    with open(summary_file, 'a') as sf:
-        sf.write(f"{file_label} {ndcg}\n")
+    return file_label, scores, run_log
 
-    if output_file:
-        with open(output_file, 'w') as outf:
-            outf.write(result.stdout)
+def summarize(scores, metrics):
+    """Mean of every metric over the evaluated queries, like trec_eval's 'all' lines."""
+    return {metric: mean_over_queries({qid: values[i] for qid, values in scores.items()})
+            for i, metric in enumerate(metrics)}
 
-    # Clean up temporary files
-    # Only unlink limited_path if it's different from cleaned_path (i.e., when max_queries was not None)
-    if limited_path != cleaned_path:
-        os.unlink(limited_path)
-    if clean:
-        os.unlink(cleaned_path)
+def write_score_file(output_file, scores, metrics):
+    with open(output_file, 'w') as outf:
+        # Same layout as trec_eval's output
+        for metric, value in summarize(scores, metrics).items():
+            outf.write(f"{metric:<22}\tall\t{value:.4f}\n")
 
+def record_result(result, summary_file, log_path=LOG_FILE, metrics=METRICS, summary_metric=SUMMARY_METRIC):
+    file_label, scores, run_log = result
+    run_log.flush(log_path)
+    if scores is None:
+        return False
+    with open(summary_file, 'a') as sf:
+        sf.write(f"{file_label} {summarize(scores, metrics)[summary_metric]:.4f}\n")
     return True
 
+def _score_run_task(task):
+    return score_run(*task)
+
 # ===== Main ===== #
-def evaluate_runs_in_directory(directory, summary_file, clean_runs, file_pattern="*.run", output_name=None, max_queries=None, max_docs_per_query=None):
+def evaluate_runs_in_directory(directory, summary_file, clean_runs, file_pattern="*.run", output_name=None, max_queries=None, max_docs_per_query=None, qrels_path=QRELS_PATH, log_path=LOG_FILE, workers=WORKERS, cache=None, metrics=METRICS, per_query_file=None, store=None, dataset=DATASET, judge=None):
+    """
+    Evaluate every run matching `file_pattern` below `directory`, fanning out over `workers`
+    processes. Results are recorded by this process in file order, so summary and log files
+    look the same as with a serial evaluation. Runs with scores in `cache` (an EvalCache)
+    are not evaluated again, and new scores are added to it.
+
+    Returns the per-query scores of the evaluated runs as a trec_metrics.MetricMatrix,
+    also saved to `per_query_file` (.npz) if given. With a `store` (a ResultsStore), the
+    scores are also written to it in one transaction, under `dataset` and `judge` (the
+    original runs' judge if None) and the system names of significance.system_name.
+    """
     path = Path(directory)
     if not path.exists():
-        log_message(f"Directory not found: {directory}")
-        return
-    for run_file in path.rglob(file_pattern):
+        log_message(f"Directory not found: {directory}", log_path)
+        return None
+    per_run = {}
+    tasks = []
+    results = {}
+    keys = {}
+    for run_file in sorted(path.rglob(file_pattern)):
         label = str(run_file.relative_to(directory)) if clean_runs is False else run_file.name
-        output_path = run_file.parent / output_name if output_name else None
-        evaluate_run(str(run_file), summary_file, label, clean=clean_runs, 
-                    output_file=str(output_path) if output_path else None,
-                    max_queries=max_queries, max_docs_per_query=max_docs_per_query)
+        output_path = str(run_file.parent / output_name) if output_name else None
+        task = (str(run_file), label, clean_runs, qrels_path, output_path, max_queries, max_docs_per_query, metrics)
+        key = keys[len(tasks)] = cache.key(run_file, qrels_path, clean_runs, max_queries, max_docs_per_query, metrics) if cache else None
+        cached = cache.get(key) if cache else None
+        if cached is not None:
+            scores = cached['scores']
+            run_log = RunLog()
+            skipped = f", {cached['malformed']} malformed lines skipped" if cached['malformed'] else ""
+            run_log.message(f"Evaluating: {run_file} (cached{skipped})")
+            run_log.entries += [(text, echo) for text, echo in cached['log']]
+            run_log.malformed = cached['malformed']
+            if output_path:
+                write_score_file(output_path, scores, metrics)
+            results[len(tasks)] = (label, scores, run_log)
+        tasks.append(task)
+
+    pending = [i for i in range(len(tasks)) if i not in results]
+    if workers <= 1 or len(pending) <= 1:
+        scored = map(_score_run_task, (tasks[i] for i in pending))
+        pool = None
+    else:
+        # Read the qrels before forking so the workers inherit them
+        load_qrels(qrels_path)
+        pool = ProcessPoolExecutor(max_workers=workers)
+        scored = pool.map(_score_run_task, (tasks[i] for i in pending))
+
+    try:
+        # Record in file order, cached results as soon as the runs before them are done
+        scored = iter(scored)
+        for i in range(len(tasks)):
+            if i not in results:
+                results[i] = next(scored)
+                if cache:
+                    cache.put(keys[i], results[i][1], results[i][2])
+            label, scores, _ = results[i]
+            if record_result(results.pop(i), summary_file, log_path, metrics):
+                per_run[label] = scores
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if cache:
+            cache.save()
+
+    matrix = build_metric_matrix(per_run, metrics)
+    if per_query_file:
+        save_metric_matrix(per_query_file, matrix)
+    if store:
+        suffix = BEFORE_SUFFIX if judge is None else "/" + file_pattern
+        systems = {system_name(label, suffix): scores for label, scores in per_run.items()}
+        rows = store.put_runs(dataset, judge or ORIGINAL_JUDGE, systems, metrics)
+        log_message(f"Stored {rows} results of {len(systems)} runs in {store.path}", log_path)
+    return matrix
 
 def main():
     clear_files([SUMMARY_BEFORE, SUMMARY_AFTER, LOG_FILE])
+    cache = EvalCache(EVAL_CACHE) if EVAL_CACHE else None
+    store = ResultsStore(RESULTS_STORE) if RESULTS_STORE else None
     log_message("=== Evaluating BEFORE reranking ===")
-    evaluate_runs_in_directory(ORIG_RUNS_DIR, SUMMARY_BEFORE, clean_runs=True, 
-                              max_queries=MAX_QUERIES, max_docs_per_query=MAX_DOCS_PER_QUERY)
+    before = evaluate_runs_in_directory(ORIG_RUNS_DIR, SUMMARY_BEFORE, clean_runs=True, 
+                              max_queries=MAX_QUERIES, max_docs_per_query=MAX_DOCS_PER_QUERY, cache=cache,
+                              per_query_file=PER_QUERY_BEFORE, store=store)
 
     log_message("=== Evaluating AFTER reranking ===")
-    evaluate_runs_in_directory(BASE_DIR, SUMMARY_AFTER, clean_runs=False, 
+    after = evaluate_runs_in_directory(BASE_DIR, SUMMARY_AFTER, clean_runs=False, 
                               file_pattern="cv-5fold-run-test.run", output_name="ndcg_scores.txt",
-                              max_queries=MAX_QUERIES, max_docs_per_query=MAX_DOCS_PER_QUERY)
+                              max_queries=MAX_QUERIES, max_docs_per_query=MAX_DOCS_PER_QUERY, cache=cache,
+                              per_query_file=PER_QUERY_AFTER, store=store, judge=JUDGE)
+    if store:
+        store.close()
+
+    if SIGNIFICANCE_AFTER and before is not None and after is not None:
+        write_significance(before, after, SIGNIFICANCE_AFTER, metric=SUMMARY_METRIC)
+        log_message(f"Significance tests written to {SIGNIFICANCE_AFTER}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, TypeVar
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+T = TypeVar('T')
+
+def peak_rss_bytes(children: bool = False) -> Optional[int]:
+    """Peak resident set size of this process (or of its largest waited-for child), None if unknown."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS, in KiB elsewhere
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+class PerfReport:
+    """
+    Wall-clock time and counters per stage of a run, written as JSON with write().
+
+    Stages are timed with the stage() context manager, or with timed() for the work done
+    inside an iterator's next(), which is how lazily streamed stages are measured. Counters
+    are free-form; a 'docs' counter adds a docs/sec rate and 'bytes_read' / 'bytes_written'
+    counters are summed over all stages.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds: Dict[str, float] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    def add_time(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.counters.setdefault(stage, {})
+
+    def count(self, stage: str, counter: str, n: int = 1):
+        counters = self.counters.setdefault(stage, {})
+        counters[counter] = counters.get(counter, 0) + n
+
+    @contextmanager
+    def stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str, items: Iterable[T]) -> Iterator[T]:
+        """Yield from `items`, adding the time spent producing each item to `stage`."""
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def to_dict(self) -> dict:
+        total = time.perf_counter() - self.started
+        stages = {}
+        for stage in self.counters:
+            seconds = self.seconds.get(stage, 0.0)
+            entry = {'seconds': round(seconds, 6), **self.counters[stage]}
+            if 'docs' in entry and seconds > 0:
+                entry['docs_per_second'] = round(entry['docs'] / seconds, 1)
+            stages[stage] = entry
+        docs = max((c.get('docs', 0) for c in self.counters.values()), default=0)
+        return {
+            'total_seconds': round(total, 6),
+            'docs': docs,
+            'docs_per_second': round(docs / total, 1) if total > 0 else None,
+            'bytes_read': sum(c.get('bytes_read', 0) for c in self.counters.values()),
+            'bytes_written': sum(c.get('bytes_written', 0) for c in self.counters.values()),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'peak_rss_children_bytes': peak_rss_bytes(children=True),
+            'stages': stages,
+        }
+
+    def write(self, path: Path):
+        with path.open('w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
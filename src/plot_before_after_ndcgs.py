@@ -2,21 +2,23 @@ import matplotlib.pyplot as plt
 import argparse
 import numpy as np
 
-def plot_before_after(before_file: str, after_files: list, model_names: list, output_path: str, dataset: str):
-    def load_ndcg_data(filepath, suffix_to_remove=""):
-        ndcg_scores = {}
-        with open(filepath, 'r') as f:
-            for line in f:
-                parts = line.strip().split()
-                if len(parts) == 2:
-                    run_name = parts[0].replace(suffix_to_remove, "")
-                    try:
-                        score = float(parts[1])
-                        ndcg_scores[run_name] = score
-                    except ValueError:
-                        continue
-        return ndcg_scores
+from results_store import ORIGINAL_JUDGE, ResultsStore
+
+def load_ndcg_data(filepath, suffix_to_remove=""):
+    ndcg_scores = {}
+    with open(filepath, 'r') as f:
+        for line in f:
+            parts = line.strip().split()
+            if len(parts) == 2:
+                run_name = parts[0].replace(suffix_to_remove, "")
+                try:
+                    score = float(parts[1])
+                    ndcg_scores[run_name] = score
+                except ValueError:
+                    continue
+    return ndcg_scores
 
+def plot_before_after(before_file: str, after_files: list, model_names: list, output_path: str, dataset: str):
     # Load before scores (common for all models)
     before = load_ndcg_data(before_file, ".run")
     
@@ -24,7 +26,20 @@ def plot_before_after(before_file: str, after_files: list, model_names: list, ou
     after_scores = {}
     for model_name, after_file in zip(model_names, after_files):
         after_scores[model_name] = load_ndcg_data(after_file, "/cv-5fold-run-test.run")
-    
+
+    plot_scores(before, after_scores, model_names, output_path, dataset)
+
+def plot_before_after_from_store(store_path: str, model_names: list, output_path: str, dataset: str, metric: str = "ndcg_cut_20"):
+    """Plot from a results store (see results_store.py) instead of summary files: one indexed lookup per judge."""
+    with ResultsStore(store_path) as store:
+        before = store.system_scores(metric, dataset, ORIGINAL_JUDGE)
+        after_scores = {model: store.system_scores(metric, dataset, model) for model in model_names}
+    missing = [judge for judge, scores in [(ORIGINAL_JUDGE, before)] + list(after_scores.items()) if not scores]
+    if missing:
+        raise ValueError(f"No {metric} results for dataset {dataset!r} and judges {missing} in {store_path}")
+    plot_scores(before, after_scores, model_names, output_path, dataset)
+
+def plot_scores(before: dict, after_scores: dict, model_names: list, output_path: str, dataset: str):
     # Find common runs across before and all after files, sort by before NDCG
     common_runs = sorted(
         set(before.keys()) & set.intersection(*(set(scores) for scores in after_scores.values())),
@@ -66,15 +81,23 @@ def plot_before_after(before_file: str, after_files: list, model_names: list, ou
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Plotting before and after summaries of NDCG scores in a bar graph for multiple models")
-    parser.add_argument("--before", required=True, type=str, help="Path to NDCG scores before reranking")
-    parser.add_argument("--after", required=True, type=str, nargs='+', help="Paths to NDCG scores after reranking for each model")
-    parser.add_argument("--models", required=True, type=str, nargs='+', help="Names of the models corresponding to after files")
-    parser.add_argument("--dataset", default="", required=False, type=str, help="the dataset to put in the plot title")
+    parser.add_argument("--before", required=False, type=str, help="Path to NDCG scores before reranking")
+    parser.add_argument("--after", required=False, type=str, nargs='+', help="Paths to NDCG scores after reranking for each model")
+    parser.add_argument("--store", required=False, type=str, help="Read the scores from this results store (written by ndcg_eval_script.py) instead of --before/--after")
+    parser.add_argument("--models", required=True, type=str, nargs='+', help="Names of the models corresponding to after files (judges in the results store)")
+    parser.add_argument("--dataset", default="", required=False, type=str, help="the dataset to put in the plot title (and to select from the results store)")
     parser.add_argument("--output", required=True, type=str, help="Path to save the bar graph figure")
     args = parser.parse_args()
-    
-    # Ensure the number of after files matches the number of model names
-    if len(args.after) != len(args.models):
-        raise ValueError("The number of after files must match the number of model names")
-    
-    plot_before_after(before_file=args.before, after_files=args.after, model_names=args.models, output_path=args.output, dataset=args.dataset)
\ No newline at end of file
+
+    if args.store:
+        if not args.dataset:
+            parser.error("--dataset is required with --store")
+        plot_before_after_from_store(store_path=args.store, model_names=args.models, output_path=args.output, dataset=args.dataset)
+    else:
+        if not args.before or not args.after:
+            raise ValueError("Either --store or both --before and --after are required")
+        # Ensure the number of after files matches the number of model names
+        if len(args.after) != len(args.models):
+            raise ValueError("The number of after files must match the number of model names")
+
+        plot_before_after(before_file=args.before, after_files=args.after, model_names=args.models, output_path=args.output, dataset=args.dataset)
\ No newline at end of file
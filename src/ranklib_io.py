@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+import numpy as np
+import logging
+
+class CsrMatrix(NamedTuple):
+    """
+    Compressed sparse row matrix: the non-zero values of row `r` are
+    `data[indptr[r]:indptr[r+1]]`, in columns `indices[indptr[r]:indptr[r+1]]`.
+    """
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    shape: tuple
+
+    def to_dense(self) -> np.ndarray:
+        dense = np.zeros(self.shape, dtype=self.data.dtype)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        dense[rows, self.indices] = self.data
+        return dense
+
+def csr_from_dense(matrix: np.ndarray) -> CsrMatrix:
+    """Keep only the non-zero entries of a dense feature matrix."""
+    rows, cols = np.nonzero(matrix)
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=matrix.shape[0]), out=indptr[1:])
+    return CsrMatrix(indptr, cols.astype(np.int32), matrix[rows, cols], matrix.shape)
+
+def feature_desc_path(ranklib_path: Path) -> Path:
+    """Sidecar file holding the feature descriptions of a RankLib file, one per line."""
+    return ranklib_path.with_name(ranklib_path.name + '.features')
+
+def write_feature_desc(ranklib_path: Path, feature_desc: List[str]):
+    with feature_desc_path(ranklib_path).open('w') as f:
+        f.writelines(f"{desc}\n" for desc in feature_desc)
+
+def remove_feature_desc(ranklib_path: Path):
+    """Delete the sidecar of an earlier sparse file at the same path, which read_ranklib would apply to a dense file."""
+    feature_desc_path(ranklib_path).unlink(missing_ok=True)
+
+def read_feature_desc(ranklib_path: Path) -> List[str]:
+    with feature_desc_path(ranklib_path).open('r') as f:
+        return [line.rstrip('\n') for line in f]
+
+class RankLibData(NamedTuple):
+    """Contents of a RankLib/SVMlight file."""
+    labels: np.ndarray
+    qids: List[str]
+    dids: List[str]
+    features: CsrMatrix
+    feature_desc: Optional[List[str]]
+
+def read_ranklib(path: Path, feature_desc: Optional[List[str]] = None) -> RankLibData:
+    """
+    Read a RankLib file (`<label> qid:<qid> <i>:<v> ... # <did>`) into a CSR matrix.
+
+    Feature `i` is stored in column `i-1`. The number of columns is taken from the
+    feature descriptions, read from the `.features` sidecar written next to sparse
+    output by build_feature_vectors.py unless given; without descriptions it is the
+    largest feature index found. Features that are absent from a line are zero, so
+    `read_ranklib(path).features.to_dense()` restores the full schema of a sparse file.
+
+    Args:
+        path: RankLib file to read.
+        feature_desc: Feature descriptions (column names), overriding the sidecar.
+    """
+    if feature_desc is None and feature_desc_path(path).exists():
+        feature_desc = read_feature_desc(path)
+
+    labels = []
+    qids = []
+    dids = []
+    indptr = [0]
+    indices = []
+    data = []
+    is_float = False
+    with path.open('r') as f:
+        for line in f:
+            body, _, comment = line.partition('#')
+            fields = body.split()
+            if len(fields) < 2 or not fields[1].startswith('qid:'):
+                logging.warning(f"Skipping malformed line: {line.strip()}")
+                continue
+            labels.append(int(fields[0]))
+            qids.append(fields[1][len('qid:'):])
+            dids.append(comment.strip())
+            for field in fields[2:]:
+                index, _, value = field.partition(':')
+                indices.append(int(index) - 1)
+                is_float = is_float or '.' in value or 'e' in value
+                data.append(value)
+            indptr.append(len(indices))
+
+    n_features = len(feature_desc) if feature_desc is not None else max(indices, default=-1) + 1
+    values = np.array(data, dtype=np.float64 if is_float else np.int64) if data else np.zeros(0)
+    features = CsrMatrix(
+        np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32), values, (len(labels), n_features)
+    )
+    return RankLibData(np.array(labels, dtype=np.int64), qids, dids, features, feature_desc)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Union
+import argparse
+import sqlite3
+
+# Judge name of the original (not reranked) runs
+ORIGINAL_JUDGE = "original"
+# Fold of results over all folds, e.g. the concatenated test folds of a cross-validated run
+ALL_FOLDS = "all"
+# Query of the mean over all evaluated queries, as in trec_eval's output
+ALL_QUERIES = "all"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    dataset TEXT NOT NULL,
+    judge   TEXT NOT NULL,
+    system  TEXT NOT NULL,
+    fold    TEXT NOT NULL,
+    metric  TEXT NOT NULL,
+    query   TEXT NOT NULL,
+    value   REAL NOT NULL,
+    PRIMARY KEY (dataset, judge, system, fold, metric, query)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_by_metric ON results (metric, query, dataset, judge);
+"""
+INSERT_ROWS = ("INSERT OR REPLACE INTO results (dataset, judge, system, fold, metric, query, value) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+class ResultRow(NamedTuple):
+    dataset: str
+    judge: str
+    system: str
+    fold: str
+    metric: str
+    query: str
+    value: float
+
+class ResultsStore:
+    """
+    Evaluation results in a local SQLite database, one row per (dataset, judge model, system,
+    fold, metric, query); query 'all' holds the mean over the queries. Results are written
+    in bulk transactions, and a later write of the same key replaces the earlier value.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = path
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self) -> 'ResultsStore':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def put(self, rows: Iterable[ResultRow]) -> int:
+        """Insert or replace `rows` in one transaction; returns the number of rows written."""
+        with self.connection:
+            cursor = self.connection.executemany(INSERT_ROWS, rows)
+        return cursor.rowcount
+
+    def put_runs(self, dataset: str, judge: str, per_run: Dict[str, Dict[str, List[float]]], metrics: Sequence[str],
+                 fold: str = ALL_FOLDS) -> int:
+        """
+        Store the per-query scores {system: {qid: [value per metric]}} of several runs, plus
+        their means over the queries (query 'all'), in one transaction. The rows stored before
+        for these systems on this fold are deleted first, so queries a run no longer has go too.
+        """
+        def rows() -> Iterator[ResultRow]:
+            for system, scores in per_run.items():
+                for qid, values in scores.items():
+                    for metric, value in zip(metrics, values):
+                        yield ResultRow(dataset, judge, system, fold, metric, qid, value)
+                for i, metric in enumerate(metrics):
+                    mean = sum(values[i] for values in scores.values()) / len(scores) if scores else 0.0
+                    yield ResultRow(dataset, judge, system, fold, metric, ALL_QUERIES, mean)
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM results WHERE dataset = ? AND judge = ? AND system = ? AND fold = ?",
+                [(dataset, judge, system, fold) for system in per_run]
+            )
+            cursor = self.connection.executemany(INSERT_ROWS, rows())
+        return cursor.rowcount
+
+    def get(self, dataset: Optional[str] = None, judge: Optional[str] = None, system: Optional[str] = None,
+            fold: Optional[str] = ALL_FOLDS, metric: Optional[str] = None, query: Optional[str] = ALL_QUERIES) -> List[ResultRow]:
+        """Rows matching every given key (None matches anything), by default the means over all folds."""
+        keys = dict(dataset=dataset, judge=judge, system=system, fold=fold, metric=metric, query=query)
+        where = [f"{column} = ?" for column, value in keys.items() if value is not None]
+        sql = "SELECT dataset, judge, system, fold, metric, query, value FROM results"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self.connection.execute(sql, [value for value in keys.values() if value is not None])
+        return [ResultRow(*row) for row in rows]
+
+    def system_scores(self, metric: str, dataset: str, judge: str, fold: str = ALL_FOLDS) -> Dict[str, float]:
+        """{system: mean `metric`} of one judge on one dataset."""
+        return {row.system: row.value for row in self.get(dataset, judge, None, fold, metric, ALL_QUERIES)}
+
+    def judges(self, dataset: Optional[str] = None) -> List[str]:
+        sql = "SELECT DISTINCT judge FROM results" + (" WHERE dataset = ?" if dataset else "") + " ORDER BY judge"
+        return [judge for judge, in self.connection.execute(sql, [dataset] if dataset else [])]
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the mean of a metric per system and judge from a results store")
+    parser.add_argument("--store", required=True, type=Path, help="Results store (SQLite) written by ndcg_eval_script.py")
+    parser.add_argument("--dataset", required=True, help="Dataset, e.g. dl19")
+    parser.add_argument("--metric", default="ndcg_cut_20", help="Metric (default: ndcg_cut_20)")
+    parser.add_argument("--judges", nargs='+', help="Judge models to compare (default: all judges of the dataset)")
+    args = parser.parse_args()
+
+    with ResultsStore(args.store) as store:
+        judges = args.judges or store.judges(args.dataset)
+        scores = {judge: store.system_scores(args.metric, args.dataset, judge) for judge in judges}
+    systems = sorted({system for values in scores.values() for system in values})
+    print("\t".join(["system"] + judges))
+    for system in systems:
+        print("\t".join([system] + [f"{scores[judge][system]:.4f}" if system in scores[judge] else "-" for judge in judges]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Iterable, Iterator, Callable, Union
+import numpy as np
+
+# TREC run lines: <qid> Q0 <docid> <rank> <score> <tag>
+RunLine = Tuple[str, str, int, float, str]
+
+def is_number(value: str) -> bool:
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+def parse_run_line(line: str, lenient: bool = False) -> Optional[RunLine]:
+    """
+    Parse one TREC run line, returning None for lines that cannot be used.
+
+    Strict parsing expects exactly six fields. Lenient parsing (as in
+    ndcg_eval_script.iter_clean_run) accepts any line with at least qid, Q0 and docid,
+    defaulting a missing or non-numeric rank to 1000, score to 0.0 and tag to AUTO.
+    """
+    fields = line.split()
+    if not lenient:
+        if len(fields) != 6:
+            return None
+        qid, _, docid, rank, score, tag = fields
+        return qid, docid, int(rank) if rank.isdigit() else 0, float(score), tag
+    if len(fields) < 3:
+        return None
+    rank = int(fields[3]) if len(fields) > 3 and fields[3].isdigit() else 1000
+    score = float(fields[4]) if len(fields) > 4 and is_number(fields[4]) else 0.0
+    tag = fields[5] if len(fields) > 5 else "AUTO"
+    return fields[0], fields[2], rank, score, tag
+
+class Vocab:
+    """Interns strings (query or doc ids) as consecutive integer codes."""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.strings: List[str] = []
+        self._sort_ranks: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.strings)
+
+    def encode(self, values: Iterable[str]) -> np.ndarray:
+        codes = self.codes
+        strings = self.strings
+        result = []
+        for value in values:
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(strings)
+                strings.append(value)
+            result.append(code)
+        return np.array(result, dtype=np.int32)
+
+    def lookup(self, values: Iterable[str]) -> np.ndarray:
+        """Codes of strings already in the vocabulary, -1 for others; the vocabulary is not changed."""
+        codes = self.codes
+        return np.array([codes.get(value, -1) for value in values], dtype=np.int32)
+
+    def decode(self, codes: np.ndarray) -> List[str]:
+        strings = self.strings
+        return [strings[c] for c in codes.tolist()]
+
+    def sort_ranks(self) -> np.ndarray:
+        """Position of every code when the strings are sorted, for ordering by string with integer keys."""
+        # Recomputed whenever strings were added since the last call
+        if self._sort_ranks is None or len(self._sort_ranks) != len(self.strings):
+            order = sorted(range(len(self.strings)), key=self.strings.__getitem__)
+            ranks = np.empty(len(order), dtype=np.int64)
+            ranks[order] = np.arange(len(order))
+            self._sort_ranks = ranks
+        return self._sort_ranks
+
+class RunVocab:
+    """Query and document vocabularies shared by runs that are joined with each other."""
+
+    def __init__(self):
+        self.qids = Vocab()
+        self.docids = Vocab()
+
+class Run:
+    """
+    A TREC run stored column-wise: interned qid/docid codes plus score and rank arrays.
+
+    Rows keep the order of the run file. Runs read with the same RunVocab can be
+    intersected with integer set operations on their (qid, docid) pair keys.
+    """
+
+    def __init__(self, vocab: RunVocab, qids: np.ndarray, docids: np.ndarray,
+                 scores: np.ndarray, ranks: np.ndarray, tags: Optional[List[str]] = None):
+        self.vocab = vocab
+        self.qids = qids
+        self.docids = docids
+        self.scores = scores
+        self.ranks = ranks
+        self.tags = tags
+
+    def __len__(self):
+        return len(self.qids)
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[RunLine], vocab: Optional[RunVocab] = None, keep_tags: bool = False,
+                   intern: bool = True) -> 'Run':
+        """
+        Build a run from parsed lines. Without `intern`, only ids already in `vocab` are
+        looked up and rows with any other id are dropped: they cannot join with the runs
+        of the vocabulary, and the vocabulary (and its cached sort order) does not grow.
+        """
+        vocab = vocab or RunVocab()
+        qids, docids, ranks, scores, tags = [], [], [], [], []
+        for qid, docid, rank, score, tag in lines:
+            qids.append(qid)
+            docids.append(docid)
+            ranks.append(rank)
+            scores.append(score)
+            if keep_tags:
+                tags.append(tag)
+        if intern:
+            return cls(
+                vocab, vocab.qids.encode(qids), vocab.docids.encode(docids),
+                np.array(scores, dtype=np.float64), np.array(ranks, dtype=np.int32), tags if keep_tags else None
+            )
+        run = cls(
+            vocab, vocab.qids.lookup(qids), vocab.docids.lookup(docids),
+            np.array(scores, dtype=np.float64), np.array(ranks, dtype=np.int32), tags if keep_tags else None
+        )
+        return run.select((run.qids >= 0) & (run.docids >= 0))
+
+    def pair_keys(self) -> np.ndarray:
+        """One int64 per row identifying its (qid, docid) pair within the vocabulary."""
+        return (self.qids.astype(np.int64) << 32) | self.docids.astype(np.int64)
+
+    def select(self, rows: Union[np.ndarray, slice]) -> 'Run':
+        return Run(self.vocab, self.qids[rows], self.docids[rows], self.scores[rows], self.ranks[rows],
+                   None if self.tags is None else [self.tags[i] for i in np.arange(len(self))[rows]])
+
+    def dedupe(self) -> 'Run':
+        """Keep one row per (qid, docid) pair: the last one, at the position of the first (like a dict)."""
+        keys = self.pair_keys()
+        _, first = np.unique(keys, return_index=True)
+        if len(first) == len(keys):
+            return self
+        # np.unique orders both by key, so first[i] and last[i] belong to the same pair
+        _, last_reversed = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last_reversed
+        order = np.argsort(first)
+        result = self.select(first[order])
+        result.scores = self.scores[last[order]]
+        result.ranks = self.ranks[last[order]]
+        return result
+
+    def isin(self, other: 'Run') -> np.ndarray:
+        """Boolean mask of the rows whose (qid, docid) pair also occurs in `other` (same vocabulary)."""
+        assert self.vocab is other.vocab, "runs must share a RunVocab to be joined"
+        return np.isin(self.pair_keys(), other.pair_keys())
+
+    def sorted_by_ids(self) -> 'Run':
+        """Rows ordered by qid string, then docid string."""
+        order = np.lexsort((self.vocab.docids.sort_ranks()[self.docids], self.vocab.qids.sort_ranks()[self.qids]))
+        return self.select(order)
+
+    def lines(self, rank: Optional[int] = None, tag: Optional[str] = None) -> Iterator[str]:
+        """
+        Format the rows as run lines; `rank` and `tag` override the stored values when given.
+        Scores are written like Python floats (e.g. '3.0').
+        """
+        qids = self.vocab.qids.decode(self.qids)
+        docids = self.vocab.docids.decode(self.docids)
+        scores = self.scores.tolist()
+        ranks = [rank] * len(self) if rank is not None else self.ranks.tolist()
+        tags = [tag] * len(self) if tag is not None else (self.tags or ['run'] * len(self))
+        for qid, docid, r, score, t in zip(qids, docids, ranks, scores, tags):
+            yield f"{qid} Q0 {docid} {r} {score} {t}\n"
+
+def iter_run_lines(
+    path: Union[str, Path],
+    lenient: bool = False,
+    on_malformed: Optional[Callable[[int, str], None]] = None
+) -> Iterator[RunLine]:
+    """
+    Stream the parsed lines of a run file, see parse_run_line.
+
+    Args:
+        path: Run file.
+        lenient: Accept and repair lines with fewer than six fields.
+        on_malformed: Called with (line number, line) for lines that are skipped, including empty ones.
+    """
+    with open(path) as f:
+        for line_num, line in enumerate(f, 1):
+            parsed = parse_run_line(line, lenient)
+            if parsed is None:
+                if on_malformed is not None:
+                    on_malformed(line_num, line.strip())
+                continue
+            yield parsed
+
+def read_run(
+    path: Union[str, Path],
+    vocab: Optional[RunVocab] = None,
+    lenient: bool = False,
+    on_malformed: Optional[Callable[[int, str], None]] = None,
+    keep_tags: bool = False,
+    intern: bool = True
+) -> Run:
+    """Load a run file into a columnar Run, interning ids into `vocab` (a new one if None; see Run.from_lines)."""
+    return Run.from_lines(iter_run_lines(path, lenient, on_malformed), vocab, keep_tags, intern)
+
+def write_run(path: Union[str, Path], run: Run, rank: Optional[int] = None, tag: Optional[str] = None):
+    with open(path, 'w') as out:
+        out.write("".join(run.lines(rank, tag)))
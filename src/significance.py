@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+import argparse
+import numpy as np
+
+from trec_metrics import MetricMatrix, load_metric_matrix
+
+# Labels of the runs in the matrices saved by ndcg_eval_script.py: original runs are
+# labelled by file name ('X.run'), reranked runs by their path below the results
+# directory ('X/cv-5fold-run-test.run'); both map to the system name 'X'.
+BEFORE_SUFFIX = ".run"
+AFTER_SUFFIX = "/cv-5fold-run-test.run"
+
+# Random signs / resamples are drawn in batches of this many to bound memory
+BATCH_SIZE = 1000
+
+class PairedScores(NamedTuple):
+    """Per-query scores of paired systems: before[p, q] vs after[p, q], mask[p, q] where both exist."""
+    systems: List[str]
+    before: np.ndarray
+    after: np.ndarray
+    mask: np.ndarray
+
+class SignificanceResult(NamedTuple):
+    systems: List[str]
+    before_mean: np.ndarray
+    after_mean: np.ndarray
+    p_permutation: np.ndarray
+    p_bootstrap: np.ndarray
+    p_permutation_adjusted: np.ndarray
+    p_bootstrap_adjusted: np.ndarray
+
+def system_name(label: str, suffix: str) -> str:
+    return label[:-len(suffix)] if label.endswith(suffix) else label
+
+def pair_runs(before: MetricMatrix, after: MetricMatrix, metric: str) -> PairedScores:
+    """Align the systems and queries of a before and an after matrix on one metric."""
+    before_index = {system_name(run, BEFORE_SUFFIX): i for i, run in enumerate(before.runs)}
+    after_index = {system_name(run, AFTER_SUFFIX): i for i, run in enumerate(after.runs)}
+    systems = [system for system in after_index if system in before_index]
+    queries = sorted(set(before.queries) & set(after.queries))
+    before_queries = {qid: j for j, qid in enumerate(before.queries)}
+    after_queries = {qid: j for j, qid in enumerate(after.queries)}
+
+    def select(matrix: MetricMatrix, index: Dict[str, int], columns: Dict[str, int]) -> np.ndarray:
+        rows = [index[system] for system in systems]
+        cols = [columns[qid] for qid in queries]
+        return matrix.values[np.ix_(rows, cols, [matrix.metrics.index(metric)])][:, :, 0]
+
+    before_values = select(before, before_index, before_queries)
+    after_values = select(after, after_index, after_queries)
+    mask = ~np.isnan(before_values) & ~np.isnan(after_values)
+    return PairedScores(systems, np.where(mask, before_values, 0.0), np.where(mask, after_values, 0.0), mask)
+
+def permutation_test(diffs: np.ndarray, mask: np.ndarray, n_permutations: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Two-sided paired randomization (sign-flip) test of every row of `diffs` at once.
+
+    The same random sign vectors are applied to all pairs, so each batch of
+    permutations is one (pairs x queries) @ (queries x batch) matrix product.
+    """
+    n = mask.sum(axis=1)
+    diffs = np.where(mask, diffs, 0.0)
+    observed = np.abs(diffs.sum(axis=1))
+    exceed = np.zeros(len(diffs))
+    for start in range(0, n_permutations, BATCH_SIZE):
+        size = min(BATCH_SIZE, n_permutations - start)
+        signs = rng.choice([-1.0, 1.0], size=(diffs.shape[1], size))
+        # Compare sums rather than means: the number of queries is fixed per pair
+        exceed += (np.abs(diffs @ signs) >= observed[:, None] - 1e-12).sum(axis=1)
+    p = (exceed + 1) / (n_permutations + 1)
+    return np.where(n > 0, p, 1.0)
+
+def bootstrap_test(diffs: np.ndarray, mask: np.ndarray, n_samples: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Two-sided paired bootstrap test of every row of `diffs` at once (shift method).
+
+    Queries are resampled with replacement as a matrix of counts shared by all pairs;
+    queries a pair has no scores for get zero weight in its resampled mean.
+    """
+    n_queries = diffs.shape[1]
+    n = mask.sum(axis=1)
+    weights = mask.astype(np.float64)
+    diffs = np.where(mask, diffs, 0.0)
+    observed = np.divide(diffs.sum(axis=1), n, out=np.zeros(len(diffs)), where=n > 0)
+    exceed = np.zeros(len(diffs))
+    for start in range(0, n_samples, BATCH_SIZE):
+        size = min(BATCH_SIZE, n_samples - start)
+        counts = rng.multinomial(n_queries, np.full(n_queries, 1.0 / n_queries), size=size).T.astype(np.float64)
+        totals = weights @ counts
+        means = np.divide(diffs @ counts, totals, out=np.zeros_like(totals), where=totals > 0)
+        # Under H0 the resampled means are centered on 0: shift them by the observed mean
+        exceed += (np.abs(means - observed[:, None]) >= np.abs(observed)[:, None] - 1e-12).sum(axis=1)
+    p = (exceed + 1) / (n_samples + 1)
+    return np.where(n > 0, p, 1.0)
+
+def holm(p: np.ndarray) -> np.ndarray:
+    """Holm-Bonferroni adjusted p-values (family-wise error rate)."""
+    m = len(p)
+    order = np.argsort(p)
+    adjusted = np.minimum(1.0, np.maximum.accumulate((m - np.arange(m)) * p[order]))
+    result = np.empty(m)
+    result[order] = adjusted
+    return result
+
+def benjamini_hochberg(p: np.ndarray) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values (false discovery rate)."""
+    m = len(p)
+    order = np.argsort(p)
+    scaled = p[order] * m / np.arange(1, m + 1)
+    adjusted = np.minimum(1.0, np.minimum.accumulate(scaled[::-1])[::-1])
+    result = np.empty(m)
+    result[order] = adjusted
+    return result
+
+CORRECTIONS = {'holm': holm, 'bh': benjamini_hochberg, 'none': lambda p: p}
+
+def compare(before: MetricMatrix, after: MetricMatrix, metric: str = "ndcg_cut_20",
+            n_permutations: int = 10000, n_bootstrap: int = 10000, correction: str = 'holm',
+            seed: Optional[int] = 0) -> SignificanceResult:
+    """
+    Paired permutation and bootstrap tests of after vs before for every system of `after`
+    that also occurs in `before`, corrected for multiple comparisons over those systems.
+
+    Args:
+        before: Per-query scores of the original runs.
+        after: Per-query scores of the reranked runs.
+        metric: Metric to compare, one of the matrices' metrics.
+        n_permutations: Random sign flips per test.
+        n_bootstrap: Bootstrap samples per test.
+        correction: 'holm', 'bh' or 'none'.
+        seed: Seed of the random generator.
+    """
+    pairs = pair_runs(before, after, metric)
+    rng = np.random.default_rng(seed)
+    diffs = pairs.after - pairs.before
+    n = pairs.mask.sum(axis=1)
+    p_permutation = permutation_test(diffs, pairs.mask, n_permutations, rng)
+    p_bootstrap = bootstrap_test(diffs, pairs.mask, n_bootstrap, rng)
+    adjust = CORRECTIONS[correction]
+
+    def mean(values: np.ndarray) -> np.ndarray:
+        return np.divide(values.sum(axis=1), n, out=np.full(len(n), np.nan), where=n > 0)
+
+    return SignificanceResult(pairs.systems, mean(pairs.before), mean(pairs.after), p_permutation, p_bootstrap,
+                              adjust(p_permutation), adjust(p_bootstrap))
+
+def format_result(result: SignificanceResult, correction: str = 'holm') -> List[str]:
+    """One tab-separated line per system, after a header line."""
+    lines = [f"# system\tbefore\tafter\tdiff\tp_permutation\tp_bootstrap\tp_permutation_{correction}\tp_bootstrap_{correction}\n"]
+    for i, system in enumerate(result.systems):
+        before, after = result.before_mean[i], result.after_mean[i]
+        lines.append(
+            f"{system}\t{before:.4f}\t{after:.4f}\t{after - before:+.4f}\t{result.p_permutation[i]:.4g}\t"
+            f"{result.p_bootstrap[i]:.4g}\t{result.p_permutation_adjusted[i]:.4g}\t{result.p_bootstrap_adjusted[i]:.4g}\n"
+        )
+    return lines
+
+def write_significance(before: MetricMatrix, after: MetricMatrix, output_path: str, correction: str = 'holm', **kwargs):
+    result = compare(before, after, correction=correction, **kwargs)
+    with open(output_path, 'w') as f:
+        f.writelines(format_result(result, correction))
+
+def main():
+    parser = argparse.ArgumentParser(description="Paired significance tests of reranked runs against the original runs, from the per-query score matrices of ndcg_eval_script.py")
+    parser.add_argument("--before", required=True, type=Path, help="Per-query scores before reranking (.npz)")
+    parser.add_argument("--after", required=True, type=Path, nargs='+', help="Per-query scores after reranking (.npz), e.g. one per judge")
+    parser.add_argument("--metric", default="ndcg_cut_20", help="Metric to compare (default: ndcg_cut_20)")
+    parser.add_argument("--permutations", type=int, default=10000, help="Random sign flips per test (default: 10000)")
+    parser.add_argument("--bootstrap", type=int, default=10000, help="Bootstrap samples per test (default: 10000)")
+    parser.add_argument("--correction", choices=list(CORRECTIONS), default='holm', help="Multiple-comparison correction over the systems of each after file (default: holm)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--output-suffix", default=".significance.txt", help="Results are written next to each after file with this suffix")
+    args = parser.parse_args()
+
+    before = load_metric_matrix(args.before)
+    for after_path in args.after:
+        output_path = after_path.with_name(after_path.stem + args.output_suffix)
+        write_significance(before, load_metric_matrix(after_path), str(output_path), correction=args.correction,
+                           metric=args.metric, n_permutations=args.permutations, n_bootstrap=args.bootstrap, seed=args.seed)
+        print(f"Wrote {output_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union, NamedTuple
+import numpy as np
+
+from run_io import Run, RunVocab
+
+class Qrels:
+    """
+    Relevance judgments with (qid, docid) interned in a RunVocab, so the grades of a
+    run's documents are found with one vectorized lookup on the pair keys.
+    """
+
+    def __init__(self, vocab: RunVocab, qids: np.ndarray, docids: np.ndarray, rels: np.ndarray):
+        self.vocab = vocab
+        keys = (qids.astype(np.int64) << 32) | docids.astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.rels = rels[order]
+        self.qids = qids[order]
+        self.judged_qids = np.unique(qids)
+        self._ideal_dcg: Dict[Optional[int], np.ndarray] = {}
+
+    def lookup(self, run: Run) -> np.ndarray:
+        """Relevance grade of every row of `run` (0 for unjudged documents)."""
+        assert run.vocab is self.vocab, "run must be read with the RunVocab of the qrels"
+        keys = run.pair_keys()
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        found = self.keys[pos] == keys if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        return np.where(found, self.rels[pos] if len(self.keys) else 0, 0)
+
+    def ideal_dcg(self, k: Optional[int]) -> np.ndarray:
+        """Ideal DCG@k per qid code (0 for queries without judgments)."""
+        if k in self._ideal_dcg:
+            return self._ideal_dcg[k]
+        gains = np.maximum(self.rels, 0).astype(np.float64)
+        # Highest grade first within each query
+        order = np.lexsort((-gains, self.qids))
+        qids, gains = self.qids[order], gains[order]
+        positions = positions_in_groups(qids)
+        keep = positions < k if k is not None else np.ones(len(qids), dtype=bool)
+        ideal = np.bincount(qids[keep], weights=gains[keep] / np.log2(positions[keep] + 2), minlength=len(self.vocab.qids))
+        self._ideal_dcg[k] = ideal
+        return ideal
+
+def read_qrels(path: Union[str, Path], vocab: Optional[RunVocab] = None) -> Qrels:
+    """Read a TREC qrels file (`qid 0 docid rel`); ids are interned into `vocab` (a new one if None)."""
+    vocab = vocab or RunVocab()
+    qids, docids, rels = [], [], []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            qids.append(fields[0])
+            docids.append(fields[2])
+            rels.append(int(fields[3]))
+    return Qrels(vocab, vocab.qids.encode(qids), vocab.docids.encode(docids), np.array(rels, dtype=np.int64))
+
+def positions_in_groups(codes: np.ndarray) -> np.ndarray:
+    """0-based position of every element within its run of equal consecutive codes."""
+    if len(codes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    lengths = np.diff(np.r_[starts, len(codes)])
+    return np.arange(len(codes)) - np.repeat(starts, lengths)
+
+class RankedRun(NamedTuple):
+    """Judged rows of a run in trec_eval's evaluation order, with their grades."""
+    qids: np.ndarray        # qid code per row
+    positions: np.ndarray   # 0-based rank within the query
+    rels: np.ndarray        # relevance grade per row
+    query_codes: np.ndarray # evaluated queries (in the run and in the qrels)
+
+def rank_run(run: Run, qrels: Qrels) -> RankedRun:
+    """
+    Order a run like trec_eval: per query by descending score, ties broken by
+    descending docid (strcmp order); the file's rank column is ignored. Only
+    queries that also occur in the qrels are kept.
+    """
+    judged = np.isin(run.qids, qrels.judged_qids)
+    run = run.select(judged)
+    docid_strings = np.array(run.vocab.docids.decode(run.docids), dtype=str)
+    _, docid_order = np.unique(docid_strings, return_inverse=True)
+    order = np.lexsort((-docid_order, -run.scores, run.qids))
+    qids = run.qids[order]
+    return RankedRun(qids, positions_in_groups(qids), qrels.lookup(run)[order], np.unique(qids))
+
+def _ndcg_values(ranked: RankedRun, qrels: Qrels, k: Optional[int]) -> np.ndarray:
+    """
+    NDCG@k of every query in `ranked.query_codes`, in that order, as computed by trec_eval's
+    ndcg_cut (k=None: ndcg): gain is the relevance grade (negative grades count as 0),
+    discount log2(rank + 1).
+    """
+    gains = np.maximum(ranked.rels, 0).astype(np.float64)
+    keep = ranked.positions < k if k is not None else np.ones(len(gains), dtype=bool)
+    n = len(qrels.vocab.qids)
+    dcg = np.bincount(ranked.qids[keep], weights=gains[keep] / np.log2(ranked.positions[keep] + 2), minlength=n)
+    ideal = qrels.ideal_dcg(k)
+    ideal = np.r_[ideal, np.zeros(n - len(ideal))]
+    codes = ranked.query_codes
+    return np.divide(dcg[codes], ideal[codes], out=np.zeros(len(codes)), where=ideal[codes] > 0)
+
+def mean_over_queries(per_query: Dict[str, float]) -> float:
+    """Average over the evaluated queries, like trec_eval's 'all' line (0 if there are none)."""
+    return sum(per_query.values()) / len(per_query) if per_query else 0.0
+
+# Metrics computed by metric_matrix, named as in trec_eval's output
+METRIC_PATTERNS = "ndcg, ndcg_cut_<k>, map, recip_rank, P_<k>"
+
+def parse_metric(name: str) -> Tuple[str, Optional[int]]:
+    """Split a trec_eval metric name into (measure, cutoff), e.g. 'ndcg_cut_20' -> ('ndcg_cut', 20)."""
+    for measure in ('ndcg_cut_', 'P_'):
+        if name.startswith(measure) and name[len(measure):].isdigit():
+            return measure[:-1], int(name[len(measure):])
+    if name in ('ndcg', 'map', 'recip_rank'):
+        return name, None
+    raise ValueError(f"Unsupported metric {name!r}, expected one of {METRIC_PATTERNS}")
+
+def metric_matrix(ranked: RankedRun, qrels: Qrels, metrics: List[str], relevance_level: int = 1) -> np.ndarray:
+    """
+    Per-query values of several trec_eval metrics from one ranking of the run.
+
+    Returns a (len(ranked.query_codes), len(metrics)) matrix. Binary metrics (map,
+    recip_rank, P_k) count grades >= `relevance_level` as relevant, like trec_eval's
+    default; ndcg and ndcg_cut_k use the grades as gains.
+
+    Args:
+        ranked: Run ordered by rank_run.
+        qrels: Judgments the run was ranked with.
+        metrics: trec_eval metric names, see parse_metric.
+        relevance_level: Lowest relevant grade for binary metrics.
+    """
+    n = len(qrels.vocab.qids)
+    codes = ranked.query_codes
+    ranks = ranked.positions + 1
+    relevant = ranked.rels >= relevance_level
+    values = np.zeros((len(codes), len(metrics)))
+
+    def per_query(weights: np.ndarray, keep: Optional[np.ndarray] = None) -> np.ndarray:
+        if keep is None:
+            return np.bincount(ranked.qids, weights=weights, minlength=n)[codes]
+        return np.bincount(ranked.qids[keep], weights=weights[keep], minlength=n)[codes]
+
+    for i, name in enumerate(metrics):
+        measure, k = parse_metric(name)
+        if measure in ('ndcg', 'ndcg_cut'):
+            values[:, i] = _ndcg_values(ranked, qrels, k)
+        elif measure == 'P':
+            values[:, i] = per_query(relevant.astype(np.float64), ranked.positions < k) / k
+        elif measure == 'map':
+            # Precision at the rank of every relevant document, over all relevant documents of the query
+            hits = np.cumsum(relevant)
+            query_start = np.arange(len(hits)) - ranked.positions
+            hits -= hits[query_start] - relevant[query_start]
+            num_rel = np.bincount(qrels.qids[qrels.rels >= relevance_level], minlength=n)[codes]
+            precision = np.where(relevant, hits / ranks, 0.0)
+            values[:, i] = np.divide(per_query(precision), num_rel, out=np.zeros(len(codes)), where=num_rel > 0)
+        elif measure == 'recip_rank':
+            first = np.full(n, np.inf)
+            np.minimum.at(first, ranked.qids[relevant], ranks[relevant])
+            values[:, i] = 1.0 / first[codes]
+    return values
+
+class MetricMatrix(NamedTuple):
+    """Per-query metric values of several runs: values[run, query, metric], NaN where a run lacks a query."""
+    values: np.ndarray
+    runs: List[str]
+    queries: List[str]
+    metrics: List[str]
+
+def build_metric_matrix(per_run: Dict[str, Dict[str, List[float]]], metrics: List[str]) -> MetricMatrix:
+    """Stack {run: {qid: [value per metric]}} into a MetricMatrix over the union of the queries."""
+    runs = list(per_run)
+    queries = sorted({qid for scores in per_run.values() for qid in scores})
+    column = {qid: j for j, qid in enumerate(queries)}
+    values = np.full((len(runs), len(queries), len(metrics)), np.nan)
+    for i, scores in enumerate(per_run.values()):
+        if scores:
+            values[i, [column[qid] for qid in scores]] = list(scores.values())
+    return MetricMatrix(values, runs, queries, list(metrics))
+
+def save_metric_matrix(path: Union[str, Path], matrix: MetricMatrix):
+    np.savez_compressed(path, values=matrix.values, runs=np.array(matrix.runs, dtype=str),
+                        queries=np.array(matrix.queries, dtype=str), metrics=np.array(matrix.metrics, dtype=str))
+
+def load_metric_matrix(path: Union[str, Path]) -> MetricMatrix:
+    with np.load(path) as data:
+        return MetricMatrix(data['values'], data['runs'].tolist(), data['queries'].tolist(), data['metrics'].tolist())